@@ -0,0 +1,8 @@
+@echo off
+python accountfy.py --monitorar
+echo =================================================================================
+echo Monitoramento encerrado.
+echo =================================================================================
+echo.
+echo Pressione qualquer tecla para encerrar...
+pause >nul
\ No newline at end of file
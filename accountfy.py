@@ -45,46 +45,69 @@ sc7_em_aprovacao = True
 
 # Caminho dos arquivos
 plano_filename = 'Accountfy - Plano de contas - Tecadi.xlsx'
-ct2_filename = 'CT2.csv'
 sa2_filename = 'SA2.csv'
 sc7_filename = 'SC7.csv'
-ct2_filename_dagnoni = 'CT2_Dagnoni.csv'
 parametros_rateio_patrimonial_filename = 'Parametros_rateio_patrimonial.xlsx'
 parametros_rateio_corporativo_filename = 'Parametros_rateio_corporativo.xlsx'
 ajustes_gerenciais_filename = 'Ajustes_gerenciais.xlsx'
 
-# Alíquotas de impostos
+# Alíquotas de impostos (o ISS de cada filial está no cadastro das empresas)
 aliquota_pis = 0.0165
 aliquota_cofins = 0.076
-aliquota_iss = {
-   "103":   0.03,
-   "105":   0.05,
-   "107":   0.03,
-   "108":   0.02,
-   "109":   0.02,
-   "114":   0.025,
-   "115":   0.02,
-   "101":   0.00
-}
 
-# Nome das filiais assim como no Accountfy
-filiais = {
-   "101":   "101 - Corporativo",
-   "103":   "103 - CD Itajaí (Salseiros)",
-   "105":   "105 - CD Curitiba",
-   "107":   "107 - CD Itajaí (Itaipava)",
-   "107TR": "107 - TR Itajaí (Itaipava)",
-   "108":   "108 - CD Navegantes",
-   "109":   "109 - CD Cajamar",
-   "110":   "110 - TR Paranaguá",
-   "111":   "111 - TR Santa Cruz do Sul",
-   "112":   "112 - TR Rio Grande",
-   "113":   "113 - TR Santos",
-   "114":   "114 - CD São José dos Pinhais",
-   "115":   "115 - CD Fazenda Rio Grande",
-   "ADM": "Patrimonial - Dagnoni e Kenig"
+# Empresas do grupo, na ordem em que os lançamentos entram no razão. Cada empresa informa:
+#   'ct2'          -> arquivo da CT2 exportado do Protheus
+#   'filial'       -> filial de todos os lançamentos da empresa (None = a filial de origem de cada lançamento da CT2)
+#   'centro_custo' -> centro de custo de todos os lançamentos da empresa (None = o centro de custo da CT2)
+#   'filiais'      -> nome das filiais assim como no Accountfy
+#   'aliquota_iss' -> alíquota de ISS de cada filial
+# Para incluir uma empresa, basta cadastrá-la aqui (as regras de transferência e rateio estão em regras_negocio.json)
+empresas = {
+    'Tecadi': {
+        'ct2': 'CT2.csv',
+        'filial': None,
+        'centro_custo': None,
+        'filiais': {
+           "101":   "101 - Corporativo",
+           "103":   "103 - CD Itajaí (Salseiros)",
+           "105":   "105 - CD Curitiba",
+           "107":   "107 - CD Itajaí (Itaipava)",
+           "107TR": "107 - TR Itajaí (Itaipava)",
+           "108":   "108 - CD Navegantes",
+           "109":   "109 - CD Cajamar",
+           "110":   "110 - TR Paranaguá",
+           "111":   "111 - TR Santa Cruz do Sul",
+           "112":   "112 - TR Rio Grande",
+           "113":   "113 - TR Santos",
+           "114":   "114 - CD São José dos Pinhais",
+           "115":   "115 - CD Fazenda Rio Grande"
+        },
+        'aliquota_iss': {
+           "103":   0.03,
+           "105":   0.05,
+           "107":   0.03,
+           "108":   0.02,
+           "109":   0.02,
+           "114":   0.025,
+           "115":   0.02,
+           "101":   0.00
+        }
+    },
+    'Dagnoni': {
+        'ct2': 'CT2_Dagnoni.csv',
+        'filial': 'ADM',
+        'centro_custo': '999999', # A Dagnoni não tem centro de custo
+        'filiais': {
+           "ADM": "Patrimonial - Dagnoni e Kenig"
+        },
+        'aliquota_iss': {}
+    }
 }
 
+# Nome das filiais e alíquotas de ISS de todas as empresas
+filiais = {codigo: nome for empresa in empresas.values() for codigo, nome in empresa['filiais'].items()}
+aliquota_iss = {codigo: aliquota for empresa in empresas.values() for codigo, aliquota in empresa['aliquota_iss'].items()}
+
 # Quais contas devem ser desconsideradas?
 def contas_desconsideradas():
     return ('1', '2')
@@ -92,37 +115,798 @@ def contas_desconsideradas():
 # Quais filiais devem ser desconsideradas?
 filiais_desconsideradas = []
 
+# Arquivo das regras de remapeamento, transferência e filtros (procurado na pasta atual e, se não existir, na pasta do script)
+regras_filename = 'regras_negocio.json'
+
+# Quantidade de linhas lidas por lote da CT2 (None = ler o arquivo inteiro de uma vez)
+ct2_tamanho_lote = 250000
+
+# Processar somente as linhas novas, alteradas ou removidas da CT2 em relação à execução anterior do mesmo arquivo (requer pyarrow)
+ct2_incremental = False
+
+# Colunas que identificam um lançamento da CT2 (chave natural exportada pelo Protheus)
+colunas_chave_ct2 = ['Filial', 'Data Lcto', 'Numero Lote', 'Sub Lote', 'Numero Doc', 'Numero Linha']
+
+# Reaproveitar as leituras anteriores dos arquivos que não mudaram (requer pyarrow)
+usar_cache = True
+cache_dir = 'Cache'
+cache_dias_retencao = 60
+
+# Índice persistente de fornecedores, atualizado a cada nova exportação da SA2 (requer pyarrow)
+indice_fornecedores_filename = 'Fornecedores.parquet'
+
+# Pasta dos arquivos gerados
+base_dir = 'Output'
+
+# Ler os arquivos de entrada em paralelo?
+leitura_paralela = True
+
+# Tamanho mínimo (MB) de uma CT2 para ser tratada em um processo separado na leitura paralela. Os processos só são
+# usados com 2 ou mais CT2 acima desse tamanho; abaixo disso, criar os processos custa mais do que a leitura em threads
+ct2_tamanho_minimo_processo_mb = 20
+
+# Processar cada mês dos arquivos de entrada separadamente, em paralelo, com um arquivo de importação por mês?
+# (também pode ser ativado na linha de comando: python accountfy.py --lote)
+processamento_em_lote = False
+
+# Processar os lançamentos fora da memória (reprocessamentos do ano inteiro)? A CT2 é lida em lotes e gravada em disco
+# por mês, e cada mês é processado como no modo em lote (requer pyarrow; também: python accountfy.py --fora-da-memoria)
+processamento_fora_da_memoria = False
+
+# Pasta temporária dos lançamentos separados por mês e quantidade de meses processados ao mesmo tempo fora da memória
+particoes_dir = 'Particoes'
+processos_fora_da_memoria = 2
+
+# Intervalo (em segundos) entre as verificações da pasta no modo serviço (python accountfy.py --monitorar)
+intervalo_monitoramento = 5
+
+# Gravar, junto com o arquivo de importação, o relatório de tempo, memória e linhas de cada etapa?
+# (o cálculo da memória dos DataFrames acrescenta alguns segundos em arquivos muito grandes)
+perfil_execucao = True
+
+# Mostrar o resumo do relatório de etapas no console? (também pode ser ativado com python accountfy.py --perfil)
+perfil_console = False
+
+# O que fazer quando uma verificação da validação falha (débitos x créditos, rateios, transferência, zeramento, plano de
+# contas e filiais): 'aviso' = mostrar no console e continuar; 'relatorio' = também gravar o relatório das falhas
+# (AAAAMMDD_HHhMM_validacao.csv) junto com o arquivo de importação; 'erro' = interromper sem gravar o arquivo de importação
+# do mês (no modo em lote e fora da memória, cada mês é validado e gravado separadamente: os meses já gravados quando
+# outro mês falha permanecem em Output). Também pode ser informado na linha de comando: python accountfy.py --validacao erro
+politica_validacao = 'relatorio'
+
+# Formatos do arquivo de importação: 'xlsx', 'csv' e/ou 'parquet'
+formatos_saida = ['xlsx']
+
+# Se o arquivo passar do limite de linhas do Excel, dividir por 'filial' ou por 'mes'
+divisao_saida = 'filial'
+
+# Gravar sempre o arquivo de importação também em parquet, para a comparação entre execuções (python accountfy.py --comparar)?
+gravar_copia_comparacao = True
+
 # Importa todas as bibliotecas necessárias
 import pandas as pd
+import numpy as np
 from datetime import datetime
 import pytz
 import os
 import shutil
+import hashlib
+import io
+import gzip
+import json
+import multiprocessing
+import time
+import sys
+import argparse
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+# Executando nas células do notebook (Jupyter/VS Code): os argumentos da linha de comando são os do kernel e, no Windows,
+# as funções definidas nas células não podem ser executadas em outros processos
+executando_no_notebook = 'ipykernel' in sys.modules
+
+# O pyarrow é opcional: quando instalado, as exportações do Protheus são lidas com o leitor multithread do Arrow
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# O xlsxwriter é opcional: quando instalado, o Excel é gravado em modo de memória constante
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+    from openpyxl import Workbook
+
+# O psutil e o resource são opcionais: usados para medir o pico de memória do processo no relatório de etapas
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # %% [markdown]
-# ## Converter os lançamentos da CT2 (Lançamentos contábeis)
+# ## Relatório de etapas
+# 
+# Cada etapa do processamento registra o tempo, o pico de memória do processo, as linhas de entrada e saída e a memória
+# ocupada pelos DataFrames resultantes. O relatório é gravado em JSON e CSV na pasta da execução.
+
+# %%
+# Pico de memória (RSS) do processo até o momento, em MB
+def memoria_pico_mb():
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        if hasattr(info, 'peak_wset'):  # Windows
+            return info.peak_wset / 2**20
+    if resource is not None:
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return pico / 2**20 if sys.platform == 'darwin' else pico / 2**10
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    return None
+
+# DataFrames contidos no valor informado (DataFrame, lista, tupla ou dicionário de DataFrames)
+def _dataframes(valor):
+    if isinstance(valor, pd.DataFrame):
+        return [valor]
+    if isinstance(valor, RazaoLancamentos):
+        valor = valor.partes
+    if isinstance(valor, dict):
+        valor = list(valor.values())
+    if isinstance(valor, (list, tuple)):
+        return [df for item in valor for df in _dataframes(item)]
+    return []
+
+class PerfilExecucao:
+    def __init__(self, ativo=perfil_execucao, console=perfil_console):
+        self.ativo = ativo
+        self.console = console
+        self.etapas = []
+        self.periodo = None
+    
+    # Perfil de um mês do modo em lote ou fora da memória: começa com as etapas já medidas no processo principal
+    # (repetidas no relatório de cada mês) e as etapas do mês são identificadas pelo período
+    def do_periodo(self, periodo):
+        perfil = PerfilExecucao(self.ativo, self.console)
+        perfil.etapas = list(self.etapas)
+        perfil.periodo = str(periodo)
+        return perfil
+    
+    # Mede o bloco da etapa. A saída da etapa é informada em medicao['saida'] dentro do bloco
+    # (ou somente a quantidade de linhas, em medicao['linhas_saida'], quando a saída não fica em memória)
+    @contextmanager
+    def etapa(self, nome, entrada=None):
+        medicao = {}
+        if not self.ativo:
+            yield medicao
+            return
+        
+        # Linhas de entrada contadas antes da etapa (o razão em partes é alterado pela própria etapa)
+        entradas = _dataframes(entrada)
+        linhas_entrada = sum(len(df) for df in entradas) if entradas else None
+        
+        inicio = time.perf_counter()
+        yield medicao
+        tempo = time.perf_counter() - inicio
+        pico = memoria_pico_mb()
+        
+        saidas = _dataframes(medicao.get('saida'))
+        self.etapas.append({
+            'Etapa': nome,
+            'Período': self.periodo,
+            'Tempo (s)': round(tempo, 3),
+            'Pico de memória (MB)': round(pico, 1) if pico is not None else None,
+            'Linhas de entrada': linhas_entrada,
+            'Linhas de saída': medicao.get('linhas_saida', sum(len(df) for df in saidas) if saidas else None),
+            'Memória da saída (MB)': round(sum(df.memory_usage(deep=True).sum() for df in saidas) / 2**20, 1) if saidas else None,
+            # No modo em lote, os meses rodam em outros processos: o pico de memória é o do processo da etapa
+            'Processo': os.getpid()
+        })
+    
+    # Grava o relatório em JSON e CSV na pasta da execução e, se configurado, mostra o resumo no console
+    def gravar(self, pasta, nome_base, **informacoes):
+        if not self.ativo:
+            return
+        
+        relatorio = pd.DataFrame(self.etapas).convert_dtypes()
+        with open(os.path.join(pasta, f'{nome_base}_etapas.json'), 'w', encoding='utf-8') as f:
+            json.dump({**informacoes, 'etapas': self.etapas}, f, ensure_ascii=False, indent=2)
+        relatorio.to_csv(os.path.join(pasta, f'{nome_base}_etapas.csv'), index=False, sep=';', decimal=',', encoding='utf-8-sig')
+        
+        if self.console:
+            print(f"\nEtapas da execução ({', '.join(f'{chave}: {valor}' for chave, valor in informacoes.items())}):")
+            print(relatorio.to_string(index=False))
+
+# %% [markdown]
+# ## Esquemas das tabelas exportadas do Protheus
+
+# %%
+# Tipos de coluna:
+#   'texto'        -> lido como texto, sem conversão
+#   'valor'        -> número com vírgula decimal (ex.: 1234,56), guardado em centavos (ex.: 123456)
+#   'codigo'       -> código numérico sem zeros à esquerda (ex.: 000123 -> 123)
+#   'centro_custo' -> centro de custo com um zero à esquerda (ex.: 10101 -> 010101)
+#   'data'         -> data no formato do Protheus (dd/mm/aaaa), convertida uma única vez na leitura
+esquemas_protheus = {
+    'CT2': {
+        'Data Lcto':    'data',
+        'Cta Debito':   'texto',
+        'Cta Credito':  'texto',
+        'Valor':        'valor',
+        'Hist Lanc':    'texto',
+        'C Custo Deb':  'centro_custo',
+        'C Custo Crd':  'centro_custo',
+        'Rotina':       'texto',
+        'Filial Orig':  'codigo'
+    },
+    'SC7': {
+        'Filial':       'codigo',
+        'Numero PC':    'texto',
+        'Fornecedor':   'codigo',
+        'Cta Contabil': 'texto',
+        'Vlr.Total':    'valor',
+        'Dt. Entrega':  'data',
+        'Centro Custo': 'centro_custo',
+        'Tipo Entrada': 'texto',
+        'Status':       'texto',
+        'Ped. Encerr.': 'texto',
+        'Resid. Elim.': 'texto'
+    },
+    'SA2': {
+        'Codigo':       'codigo',
+        'Razao Social': 'texto'
+    }
+}
+
+# Formato das datas exportadas pelo Protheus (também usado nas datas do arquivo de importação)
+formato_data_protheus = '%d/%m/%Y'
+
+# Aplica as conversões que não são feitas pelo leitor (valores, códigos, centros de custo e datas)
+def tratar_colunas_protheus(df, esquema):
+    for coluna, tipo in esquema.items():
+        if tipo == 'valor':
+            df[coluna] = para_centavos(df[coluna])
+        elif tipo == 'codigo':
+            df[coluna] = df[coluna].str.strip().str.lstrip('0')
+        elif tipo == 'centro_custo':
+            codigo = df[coluna].str.strip()
+            df[coluna] = ('0' + codigo.str.replace(r'^0+(?=\d)', '', regex=True)).where(codigo.str.fullmatch(r'\d+'), '')
+        elif tipo == 'data':
+            # Datas vazias ou inválidas ficam como NaT
+            df[coluna] = pd.to_datetime(df[coluna].str.strip(), format=formato_data_protheus, errors='coerce')
+    return df
+
+# Lê os arquivos com o pyarrow, em uma única passada já tipada. O Arrow não aceita linhas com menos campos que o
+# cabeçalho (como um SA2 sem a última coluna): nesse caso, o arquivo é lido pelo leitor do pandas, que completa os
+# campos que faltam com vazios, para que as duas leituras aceitem os mesmos arquivos
+def _ler_protheus_pyarrow(filename, esquema, tamanho_lote):
+    linhas_curtas = []
+    def linha_invalida(linha):
+        if linha.actual_columns < linha.expected_columns:
+            linhas_curtas.append(linha.text)
+        return 'error'
+    
+    opcoes = dict(
+        read_options=pa_csv.ReadOptions(skip_rows=2, encoding='latin-1'),
+        parse_options=pa_csv.ParseOptions(delimiter=';', quote_char='"', invalid_row_handler=linha_invalida),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=list(esquema),
+            column_types={coluna: pa.float64() if tipo == 'valor' else pa.string() for coluna, tipo in esquema.items()},
+            decimal_point=','
+        )
+    )
+    
+    entregues = 0
+    try:
+        for lote in _lotes_pyarrow(filename, opcoes, tamanho_lote):
+            yield lote
+            entregues += len(lote)
+    except pa.ArrowInvalid:
+        if not linhas_curtas:
+            raise
+        origem = filename if isinstance(filename, (str, os.PathLike)) else 'Arquivo em memória'
+        print(f"{origem}: linha com menos campos que o cabeçalho ({linhas_curtas[0]}), arquivo lido pelo pandas")
+        
+        # Continuar pelo leitor do pandas a partir da primeira linha ainda não entregue
+        if hasattr(filename, 'seek'):
+            filename.seek(0)
+        for lote in _ler_protheus_pandas(filename, esquema, tamanho_lote):
+            if entregues >= len(lote):
+                entregues -= len(lote)
+                continue
+            yield lote.iloc[entregues:].reset_index(drop=True)
+            entregues = 0
+
+def _lotes_pyarrow(filename, opcoes, tamanho_lote):
+    if tamanho_lote is None:
+        yield pa_csv.read_csv(filename, **opcoes).to_pandas()
+        return
+    
+    # Agrupa os blocos lidos pelo Arrow em lotes de tamanho fixo
+    pendentes, linhas = [], 0
+    for bloco in pa_csv.open_csv(filename, **opcoes):
+        pendentes.append(bloco)
+        linhas += bloco.num_rows
+        while linhas >= tamanho_lote:
+            tabela_arrow = pa.Table.from_batches(pendentes)
+            yield tabela_arrow.slice(0, tamanho_lote).to_pandas()
+            pendentes = tabela_arrow.slice(tamanho_lote).to_batches()
+            linhas -= tamanho_lote
+    if linhas:
+        yield pa.Table.from_batches(pendentes).to_pandas()
+
+# Lê os arquivos com o leitor padrão do pandas, quando o pyarrow não está instalado
+def _ler_protheus_pandas(filename, esquema, tamanho_lote):
+    valores = [coluna for coluna, tipo in esquema.items() if tipo == 'valor']
+    leitura = dict(
+        sep=';', encoding='latin-1', quotechar='"', skiprows=2, usecols=list(esquema), decimal=',',
+        dtype={coluna: float if tipo == 'valor' else str for coluna, tipo in esquema.items()},
+        keep_default_na=False, na_values={coluna: [''] for coluna in valores}
+    )
+    
+    if tamanho_lote is None:
+        yield pd.read_csv(filename, **leitura)
+        return
+    
+    with pd.read_csv(filename, chunksize=tamanho_lote, **leitura) as leitor:
+        yield from leitor
+
+# Lê uma exportação do Protheus (CSV separado por ponto e vírgula, pulando as 2 primeiras linhas) conforme o esquema da tabela.
+# Com tamanho_lote, retorna um iterador de DataFrames com no máximo tamanho_lote linhas cada.
+# Colunas adicionais fora do esquema são lidas como texto
+def ler_protheus(filename, tabela, tamanho_lote=None, colunas_adicionais=()):
+    esquema = {**{coluna: 'texto' for coluna in colunas_adicionais}, **esquemas_protheus[tabela]}
+    leitor = _ler_protheus_pyarrow if pa is not None else _ler_protheus_pandas
+    lotes = (tratar_colunas_protheus(lote, esquema) for lote in leitor(filename, esquema, tamanho_lote))
+    
+    if tamanho_lote is None:
+        return next(lotes)
+    
+    return lotes
+
+# %% [markdown]
+# ## Valores em centavos
+# 
+# Os valores são guardados em centavos (inteiros de 64 bits) da leitura até a gravação do arquivo de importação:
+# somas, saldos e comparações são exatas. Os valores calculados com percentuais e alíquotas são arredondados para
+# centavos e os rateios distribuem o saldo pelo maior resto, para que as partes somem exatamente o valor rateado.
+
+# %%
+# Arredonda valores calculados em centavos para centavos inteiros (metade para o par, como o round do Python)
+def arredondar_centavos(valores):
+    return np.rint(valores).astype('int64')
+
+# Converte valores em reais para centavos (valores vazios viram zero)
+def para_centavos(valores):
+    return arredondar_centavos(pd.Series(valores).fillna(0) * 100)
+
+# Converte valores em centavos para reais, somente na gravação dos arquivos
+def para_reais(centavos):
+    return centavos / 100
+
+# Distribui cada total (em centavos) pelos percentuais, pelo método do maior resto: cada parte recebe o valor
+# truncado e os centavos que faltam vão para as partes com maior fração (em caso de empate, na ordem dos percentuais).
+# Retorna a matriz totais x percentuais; cada linha soma exatamente o total arredondado x soma dos percentuais
+def ratear_centavos(totais, percentuais):
+    totais = np.asarray(totais, dtype='int64')
+    percentuais = np.asarray(percentuais, dtype=float)
+    
+    exatos = np.abs(totais)[:, None] * percentuais[None, :]
+    partes = np.floor(exatos).astype('int64')
+    faltantes = arredondar_centavos(np.abs(totais) * percentuais.sum()) - partes.sum(axis=1)
+    
+    # Posição de cada parte na ordem decrescente da fração
+    ordem = np.argsort(-(exatos - partes), axis=1, kind='stable')
+    posicoes = np.empty_like(ordem)
+    np.put_along_axis(posicoes, ordem, np.broadcast_to(np.arange(len(percentuais)), ordem.shape), axis=1)
+    partes += posicoes < faltantes[:, None]
+    
+    return np.sign(totais)[:, None] * partes
+
+# %% [markdown]
+# ## Cache das leituras dos arquivos de entrada
+
+# %%
+# Incrementar sempre que o tratamento feito na leitura dos arquivos mudar, para invalidar o cache existente
+versao_leitura = 3
+
+# Calcula o hash do conteúdo do arquivo. O hash é reaproveitado enquanto a data de modificação e o tamanho
+# do arquivo não mudarem (o cache e o arquivo das entradas calculam o hash dos mesmos arquivos)
+def hash_arquivo(filename):
+    return _hash_conteudo(os.path.abspath(filename), assinatura_arquivo(filename))
+
+@lru_cache(maxsize=256)
+def _hash_conteudo(filename, assinatura):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(bloco)
+    return h.hexdigest()
+
+# Grava o arquivo em um temporário na mesma pasta e só então o renomeia para o nome final,
+# para que uma falha nunca deixe um arquivo de importação pela metade
+def gravar_atomico(caminho, gravar):
+    pasta, nome = os.path.split(caminho)
+    temporario = os.path.join(pasta, f'~{nome}.tmp')
+    try:
+        gravar(temporario)
+        os.replace(temporario, caminho)
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+def _gravar_cache(df, caminho):
+    # O parquet só aceita nomes de coluna em texto: guarda quais colunas eram datas (meses dos parâmetros de rateio)
+    colunas_data = [i for i, coluna in enumerate(df.columns) if isinstance(coluna, datetime)]
+    tabela = pa.Table.from_pandas(df.set_axis([str(coluna) for coluna in df.columns], axis=1), preserve_index=False)
+    metadados = dict(tabela.schema.metadata or {})
+    metadados[b'accountfy_colunas_data'] = json.dumps(colunas_data).encode()
+    
+    gravar_atomico(caminho, partial(pq.write_table, tabela.replace_schema_metadata(metadados)))
+
+def _ler_cache(caminho):
+    tabela = pq.read_table(caminho)
+    colunas_data = json.loads(tabela.schema.metadata.get(b'accountfy_colunas_data', b'[]'))
+    df = tabela.to_pandas()
+    df.columns = [pd.Timestamp(coluna) if i in colunas_data else coluna for i, coluna in enumerate(df.columns)]
+    return df
+
+# Lê o arquivo com a função informada, reaproveitando o resultado de uma leitura anterior do mesmo conteúdo
+# (tipo None = leitura sem cache)
+def ler_com_cache(filename, leitor, tipo):
+    if not usar_cache or pa is None or tipo is None:
+        return leitor(filename)
+    
+    # A chave considera o conteúdo do arquivo, o tipo de leitura e a versão do tratamento
+    versao = json.dumps([tipo, versao_leitura, esquemas_protheus.get(tipo)], ensure_ascii=False)
+    chave = hashlib.sha256(f'{hash_arquivo(filename)}|{versao}'.encode()).hexdigest()
+    caminho = os.path.join(cache_dir, f'{tipo}_{chave}.parquet')
+    
+    if os.path.exists(caminho):
+        os.utime(caminho)
+        return _ler_cache(caminho)
+    
+    df = leitor(filename)
+    
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        _gravar_cache(df, caminho)
+    except (pa.ArrowException, OSError) as erro:
+        # Colunas com tipos misturados não podem ser gravadas em parquet: segue sem cache para este arquivo
+        print(f"Aviso: não foi possível gravar o cache de {filename}: {erro}")
+    
+    return df
+
+# Remove do cache os arquivos que não são utilizados há mais de cache_dias_retencao dias
+def limpar_cache():
+    if not os.path.isdir(cache_dir):
+        return
+    
+    limite = time.time() - cache_dias_retencao * 86400
+    for nome in os.listdir(cache_dir):
+        caminho = os.path.join(cache_dir, nome)
+        if os.path.getmtime(caminho) < limite:
+            os.remove(caminho)
+
+# %% [markdown]
+# ## Índice de fornecedores (SA2)
+# 
+# A SA2 é exportada só de tempos em tempos. Cada exportação nova é incorporada ao índice persistente de fornecedores
+# (Fornecedores.parquet): códigos novos são acrescentados, códigos existentes recebem a razão social da exportação mais
+# recente e os demais são mantidos. Uma exportação já incorporada não é lida novamente, e os nomes dos fornecedores
+# da SC7 continuam disponíveis quando a SA2.csv não está na pasta.
 
 # %%
-def process_ct2(filename):
-    # Ler CT2 pulando 2 primeiras linhas
-    df = pd.read_csv(filename, sep=';', encoding='latin-1', quotechar='"', skiprows=2, low_memory=False)
+colunas_fornecedores = ['Codigo', 'Razao Social']
+
+# Quantidade de exportações da SA2 lembradas no índice (pelo hash do arquivo)
+exportacoes_sa2_guardadas = 50
+
+# Retorna o índice de fornecedores e os hashes das exportações da SA2 já incorporadas
+def ler_indice_fornecedores():
+    vazio = pd.DataFrame({coluna: pd.Series(dtype=object) for coluna in colunas_fornecedores})
+    if pa is None or not os.path.exists(indice_fornecedores_filename):
+        return vazio, []
+    
+    tabela = pq.read_table(indice_fornecedores_filename)
+    metadados = json.loads(tabela.schema.metadata.get(b'accountfy_fornecedores', b'{}'))
+    
+    # Índice gravado com outro tratamento dos códigos: recomeçar a partir da próxima exportação
+    if metadados.get('versao_leitura') != versao_leitura:
+        return vazio, []
+    
+    return tabela.to_pandas(), metadados['exportacoes']
+
+# Incorpora a exportação da SA2 ao índice de fornecedores (se ainda não foi incorporada) e retorna o índice.
+# Sem o pyarrow, apenas lê a SA2
+def atualizar_indice_fornecedores(filename):
+    if pa is None:
+        return ler_protheus(filename, 'SA2')
     
-    # Conversões iniciais
-    df['Valor'] = pd.to_numeric(df['Valor'].str.replace(',', '.'), errors='coerce')
-    df['C Custo Deb'] = pd.to_numeric(df['C Custo Deb'], errors='coerce')
-    df['C Custo Crd'] = pd.to_numeric(df['C Custo Crd'], errors='coerce')
+    indice, exportacoes = ler_indice_fornecedores()
+    hash_sa2 = hash_arquivo(filename)
+    if hash_sa2 in exportacoes:
+        return indice
     
-    # Tratar centros de custo
-    df['C Custo Deb'] = df['C Custo Deb'].apply(lambda x: f'0{int(x)}' if pd.notnull(x) else '')
-    df['C Custo Crd'] = df['C Custo Crd'].apply(lambda x: f'0{int(x)}' if pd.notnull(x) else '')
+    # Em caso de código repetido na SA2, vale o último
+    novos = ler_protheus(filename, 'SA2')[colunas_fornecedores].drop_duplicates('Codigo', keep='last')
+    indice = pd.concat([indice[~indice['Codigo'].isin(novos['Codigo'])], novos], ignore_index=True)
+    
+    metadados = {'versao_leitura': versao_leitura, 'exportacoes': (exportacoes + [hash_sa2])[-exportacoes_sa2_guardadas:]}
+    tabela = pa.Table.from_pandas(indice, preserve_index=False)
+    tabela = tabela.replace_schema_metadata({**(tabela.schema.metadata or {}), b'accountfy_fornecedores': json.dumps(metadados).encode()})
+    gravar_atomico(indice_fornecedores_filename, partial(pq.write_table, tabela))
+    
+    print(f"{filename}: {len(novos)} fornecedor(es) incorporado(s) ao índice de fornecedores ({len(indice)} no total)")
+    return indice
+
+# %% [markdown]
+# ## Leitura dos arquivos de parâmetros (Excel)
+
+# %%
+# Converte códigos lidos do Excel (números ou textos) para texto, sem o sufixo '.0'
+def codigo_excel(serie):
+    return serie.map(lambda x: x if pd.isna(x) else str(int(x)) if isinstance(x, float) and x.is_integer() else str(x))
+
+def ler_plano_contas(filename):
+    # Ler plano de contas pulando 3 primeiras linhas
+    plano_contas = pd.read_excel(filename, sheet_name='CONTAS_CONTABEIS', skiprows=3)
+    plano_contas = plano_contas[['Código da conta', 'Nome da conta']].copy()
+    plano_contas['Código da conta'] = plano_contas['Código da conta'].astype(str)
+    return plano_contas
+
+def ler_parametros_rateio(filename):
+    rateio = pd.read_excel(filename)
+    rateio['Cod filial'] = codigo_excel(rateio['Cod filial'])
+    rateio['Filial'] = rateio['Filial'].astype(str)
+    return rateio
+
+def ler_ajustes_gerenciais(filename):
+    ajustes = pd.read_excel(filename)
+    ajustes = ajustes[[coluna for coluna in ['Conta', 'Valor', 'D/C', 'Hist Lanc', 'Centro de custo', 'Filial Orig', 'Obs'] if coluna in ajustes.columns]].copy()
+    ajustes['Conta'] = ajustes['Conta'].astype(str)
+    ajustes['Valor'] = para_centavos(ajustes['Valor'])
+    ajustes['Centro de custo'] = ajustes['Centro de custo'].astype(str)
+    ajustes['Filial Orig'] = ajustes['Filial Orig'].astype(str)
+    return ajustes
+
+# %% [markdown]
+# ## Códigos das contas e das filiais
+# 
+# No razão, 'Conta' e 'Cod filial' são colunas categóricas (cada texto distinto é guardado uma única vez e as linhas
+# guardam apenas um código inteiro) e a classe (primeiro dígito) e o grupo (dois primeiros dígitos) da conta são
+# calculados uma única vez, nas colunas 'Classe' e 'Grupo'. Os filtros das etapas seguintes comparam esses códigos
+# inteiros em vez de percorrer os textos de todas as linhas.
+
+# %%
+# Aplica o teste (que recebe um Index de textos e retorna um array de booleanos) uma única vez por valor distinto
+# da coluna e expande o resultado para as linhas
+def testar_por_valor(serie, teste):
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        codigos, valores = serie.cat.codes.to_numpy(), serie.cat.categories
+    else:
+        codigos, valores = pd.factorize(serie)
     
-    # Converter contas para string
-    df['Cta Debito'] = df['Cta Debito'].astype(str)
-    df['Cta Credito'] = df['Cta Credito'].astype(str)
+    resultado = np.append(np.asarray(teste(pd.Index(valores, dtype=object)), dtype=bool), False)  # código -1 (vazio) -> False
+    return pd.Series(resultado[codigos], index=serie.index)
+
+# Aplica a conversão (que recebe um Index com os valores distintos e retorna os valores convertidos) uma única vez por
+# valor distinto da coluna e expande o resultado para as linhas (valores vazios continuam vazios)
+def converter_por_valor(serie, conversao):
+    codigos, valores = pd.factorize(serie)
+    resultado = np.append(np.asarray(conversao(valores), dtype=object), np.nan)
+    return pd.Series(resultado[codigos], index=serie.index)
+
+# Número formado pelos primeiros dígitos de cada valor distinto da coluna categórica (-1 quando não for numérico)
+def _digitos_iniciais(serie, quantidade):
+    digitos = pd.to_numeric(serie.cat.categories.str[:quantidade], errors='coerce')
+    digitos = np.append(np.nan_to_num(np.asarray(digitos, dtype=float), nan=-1), -1).astype('int8')
+    return pd.Series(digitos[serie.cat.codes.to_numpy()], index=serie.index)
+
+# Contas dos lançamentos gerados pelo processamento (rateios, impostos e zeramento), já incluídas nas categorias
+def contas_lancamentos_automaticos():
+    contas = {pool['conta'] for regra in [regra_rateio_patrimonial, regra_rateio_corporativo] for pool in regra['pools']}
+    return contas | set(impostos_recalculo) | {'2303010999'}
+
+# Categorias de 'Conta' e 'Cod filial' para os lançamentos: todos os valores dos DataFrames, todas as filiais e as
+# contas geradas pelo processamento, para que os lançamentos acrescentados e as mudanças de filial não precisem de
+# novas categorias
+def categorias_contas(dfs):
+    categorias = {}
+    for coluna, adicionais in [('Conta', contas_lancamentos_automaticos()), ('Cod filial', set(filiais))]:
+        valores = set(adicionais)
+        for df in dfs:
+            valores.update(df[coluna].cat.categories if isinstance(df[coluna].dtype, pd.CategoricalDtype) else pd.unique(df[coluna]))
+        categorias[coluna] = sorted(valores)
+    return categorias
+
+# Converte 'Conta' e 'Cod filial' em categóricas (com as categorias informadas ou as de categorias_contas) e calcula
+# a classe e o grupo de cada conta. As colunas são alteradas no próprio DataFrame
+def codificar_contas(df, categorias=None):
+    categorias = categorias or categorias_contas([df])
+    for coluna in ['Conta', 'Cod filial']:
+        df[coluna] = pd.Categorical(df[coluna], categories=categorias[coluna])
     
+    df['Classe'] = _digitos_iniciais(df['Conta'], 1)
+    df['Grupo'] = _digitos_iniciais(df['Conta'], 2)
+    return df
+
+# %% [markdown]
+# ## Regras de negócio
+# 
+# Os remapeamentos de filiais e contas, as transferências para a 107TR, as contas removidas no zeramento e os centros
+# de custo padrão estão no arquivo regras_negocio.json, separados por fase. Cada regra tem condições (todas precisam
+# ser atendidas) e uma ação: 'definir' um valor em uma coluna, 'mapear' os valores de uma coluna (DE-PARA) ou
+# 'manter' (true/false) a linha. As máscaras de todas as regras da fase são calculadas sobre os valores anteriores à
+# fase e combinadas em uma única seleção por coluna: vale a primeira regra da lista que atende a linha.
+# Valores iniciados com '@' referenciam as listas nomeadas do arquivo.
+
+# %%
+# Versão do arquivo de regras que este script sabe aplicar
+versao_regras = 1
+
+# Condições das regras: nome -> função(df, valor da condição) que retorna a máscara das linhas atendidas
+condicoes_regras = {
+    'conta':              lambda df, contas: df['Conta'].isin(contas),
+    'conta_exceto':       lambda df, contas: ~df['Conta'].isin(contas),
+    'conta_formato':      lambda df, padrao: testar_por_valor(df['Conta'], lambda contas: contas.str.fullmatch(padrao)),
+    'classe':             lambda df, classes: df['Classe'].isin(classes),
+    'grupo':              lambda df, grupos: df['Grupo'].isin(grupos),
+    'filial':             lambda df, filiais_regra: df['Cod filial'].isin(filiais_regra),
+    'filial_exceto':      lambda df, filiais_regra: ~df['Cod filial'].isin(filiais_regra),
+    'centro_custo_vazio': lambda df, vazio: (df['Centro de custo'].isna() | (df['Centro de custo'] == '')) == vazio
+}
+
+acoes_regras = ['definir', 'mapear', 'manter']
+
+# Arquivo de regras na pasta atual ou, se não existir, na pasta do script (no notebook não há __file__: somente a pasta atual)
+def caminho_regras():
+    if os.path.exists(regras_filename):
+        return regras_filename
+    
+    script = globals().get('__file__')
+    pasta = os.path.dirname(os.path.abspath(script)) if script else os.getcwd()
+    caminho = os.path.join(pasta, regras_filename)
+    if not os.path.exists(caminho):
+        procurados = dict.fromkeys([os.path.abspath(regras_filename), os.path.abspath(caminho)])
+        raise FileNotFoundError(f"Arquivo de regras não encontrado: {' nem '.join(procurados)}")
+    return caminho
+
+# Troca as referências '@lista' pelos valores das listas nomeadas
+def _resolver_listas(valor, listas):
+    if isinstance(valor, str) and valor.startswith('@'):
+        return listas[valor[1:]]
+    if isinstance(valor, dict):
+        return {chave: _resolver_listas(item, listas) for chave, item in valor.items()}
+    return valor
+
+@lru_cache(maxsize=None)
+def _ler_regras(caminho, assinatura):
+    with open(caminho, encoding='utf-8') as f:
+        regras = json.load(f)
+    
+    if regras.get('versao') != versao_regras:
+        raise ValueError(f"Versão {regras.get('versao')} do arquivo de regras {caminho} não suportada (esperada: {versao_regras})")
+    
+    listas = regras.get('listas', {})
+    for fase, regras_fase in regras['fases'].items():
+        for regra in regras_fase:
+            desconhecidas = set(regra['quando']) - set(condicoes_regras)
+            acoes = [acao for acao in acoes_regras if acao in regra]
+            if desconhecidas or len(acoes) != 1:
+                raise ValueError(f"Regra inválida na fase {fase}: {regra.get('nome')} (condições desconhecidas: {sorted(desconhecidas)}, ações: {acoes})")
+            regra['quando'] = _resolver_listas(regra['quando'], listas)
+            regra[acoes[0]] = _resolver_listas(regra[acoes[0]], listas)
+    
+    return regras
+
+# Regras de negócio, lidas novamente somente quando o arquivo muda
+def carregar_regras():
+    caminho = caminho_regras()
+    return _ler_regras(caminho, assinatura_arquivo(caminho))
+
+# Lista nomeada do arquivo de regras
+def lista_regras(nome):
+    return carregar_regras()['listas'][nome]
+
+def _mascara_regra(df, regra):
+    mascara = np.ones(len(df), dtype=bool)
+    for condicao, valor in regra['quando'].items():
+        mascara &= np.asarray(condicoes_regras[condicao](df, valor), dtype=bool)
+    return mascara
+
+# Valores da coluna (códigos, se for categórica) após a seleção da primeira regra que altera cada linha
+def _selecionar_valores(serie, alteracoes):
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        novos = {valor for _, acao, valor in alteracoes for valor in (valor.values() if acao == 'mapear' else [valor])}
+        serie = serie.cat.add_categories(sorted(novos - set(serie.cat.categories)))
+        categorias = serie.cat.categories
+        atuais = serie.cat.codes.to_numpy()
+        
+        escolhas = []
+        for _, acao, valor in alteracoes:
+            if acao == 'definir':
+                escolhas.append(categorias.get_loc(valor))
+            else:
+                # DE-PARA aplicado uma única vez por categoria
+                de_para = np.append(categorias.get_indexer(categorias.map(lambda categoria: valor.get(categoria, categoria))), -1)
+                escolhas.append(de_para[atuais])
+        codigos = np.select([mascara for mascara, _, _ in alteracoes], escolhas, default=atuais)
+        return pd.Series(pd.Categorical.from_codes(codigos, dtype=serie.dtype), index=serie.index)
+    
+    atuais = serie.to_numpy(dtype=object)
+    escolhas = [valor if acao == 'definir' else serie.map(lambda atual: valor.get(atual, atual)).to_numpy(dtype=object) for _, acao, valor in alteracoes]
+    return pd.Series(np.select([mascara for mascara, _, _ in alteracoes], escolhas, default=atuais), index=serie.index)
+
+# Linhas da máscara em um novo DataFrame, que pode ser alterado no lugar pelas próximas etapas (take, e não df[mascara],
+# que fica marcado como cópia do DataFrame original). Sem linhas removidas, retorna o próprio DataFrame
+def filtrar_linhas(df, mascara):
+    mascara = np.asarray(mascara, dtype=bool)
+    return df if mascara.all() else df.take(np.flatnonzero(mascara))
+
+# Aplica as regras da fase em uma única seleção por coluna alterada. As colunas alteradas são substituídas no próprio
+# DataFrame (sem copiar as demais colunas) e somente a remoção de linhas gera um novo DataFrame. Com o índice de saldos,
+# os lançamentos alterados ou removidos são atualizados no índice
+def aplicar_regras(df, fase, indice=None):
+    regras = carregar_regras()['fases'].get(fase, [])
+    if not regras or df.empty:
+        return df
+    
+    mascaras = [_mascara_regra(df, regra) for regra in regras]
+    
+    # Alterações por coluna, na ordem de precedência das regras
+    alteracoes = {}
+    for mascara, regra in zip(mascaras, regras):
+        for acao in ['definir', 'mapear']:
+            for coluna, valor in regra.get(acao, {}).items():
+                alteracoes.setdefault(coluna, []).append((mascara, acao, valor))
+    
+    if alteracoes:
+        # Os lançamentos alterados saem do índice com os valores anteriores e voltam com os novos
+        atualizar_indice = indice is not None and {'Conta', 'Cod filial'} & set(alteracoes)
+        if atualizar_indice:
+            alterados = np.logical_or.reduce([mascara for coluna in ['Conta', 'Cod filial'] for mascara, _, _ in alteracoes.get(coluna, [])])
+            indice.remover(df[alterados])
+        
+        for coluna, lista in alteracoes.items():
+            df[coluna] = _selecionar_valores(df[coluna], lista)
+        if 'Conta' in alteracoes:
+            df['Classe'] = _digitos_iniciais(df['Conta'], 1)
+            df['Grupo'] = _digitos_iniciais(df['Conta'], 2)
+        
+        if atualizar_indice:
+            indice.adicionar(df[alterados])
+    
+    # Linhas mantidas: vale a primeira regra com 'manter' que atende a linha (as demais são mantidas)
+    filtros = [(mascara, regra['manter']) for mascara, regra in zip(mascaras, regras) if 'manter' in regra]
+    if filtros:
+        manter = np.select([mascara for mascara, _ in filtros], [valor for _, valor in filtros], default=True).astype(bool)
+        if indice is not None:
+            indice.remover(df[~manter])
+        df = filtrar_linhas(df, manter)
+    
+    return df
+
+# %% [markdown]
+# ## Converter os lançamentos da CT2 (Lançamentos contábeis)
+
+# %%
+# Colunas mantidas após o tratamento da CT2
+colunas_ct2_resultado = ['Conta', 'Valor', 'D/C', 'Hist Lanc', 'Data Lcto', 'Centro de custo', 'Filial Orig', 'Obs']
+
+def normalizar_ct2(df):
+    # Valor, contas e centros de custo já chegam tipados pelo esquema da CT2
     # Limpar contra partidas
-    df.loc[~df['Cta Debito'].str.startswith(('3', '4', '5', '6', '7', '8', '9')), 'Cta Debito'] = ''
-    df.loc[~df['Cta Credito'].str.startswith(('3', '4', '5', '6', '7', '8', '9')), 'Cta Credito'] = ''
+    resultado = lambda contas: contas.str.startswith(('3', '4', '5', '6', '7', '8', '9'))
+    df.loc[~testar_por_valor(df['Cta Debito'], resultado), 'Cta Debito'] = ''
+    df.loc[~testar_por_valor(df['Cta Credito'], resultado), 'Cta Credito'] = ''
     
     # Criar D/C
     df['D/C'] = ''
@@ -131,8 +915,7 @@ def process_ct2(filename):
     
     # Criar Conta
     df['Conta'] = df['Cta Debito'].where(df['Cta Debito'] != '', df['Cta Credito'])
-    df['Conta'] = df['Conta'].astype(str).str.replace('.0', '')
-    df = df[(df['Conta'] != 'nan') & (df['Conta'] != '')]
+    df = df[df['Conta'] != ''].copy()
     
     # Criar Centro de custo
     df['Centro de custo'] = df['C Custo Deb'].where(df['C Custo Deb'] != '', df['C Custo Crd'])
@@ -146,58 +929,265 @@ def process_ct2(filename):
     # Ajustar histórico para lançamentos do RH
     df.loc[df['Rotina'] == 'CTBA500', 'Obs'] = 'RH / Folha de pagamento'
     
-    return df
+    # Manter somente as colunas utilizadas nas próximas etapas
+    return df[colunas_ct2_resultado]
 
-# Processar arquivos
-df_tecadi = process_ct2(ct2_filename)
-df_dagnoni = process_ct2(ct2_filename_dagnoni)
+def process_ct2(filename, tamanho_lote=ct2_tamanho_lote):
+    if tamanho_lote is None:
+        return normalizar_ct2(ler_protheus(filename, 'CT2'))
+    
+    # Ler e tratar a CT2 em lotes, mantendo em memória apenas as linhas resultantes de cada lote
+    lotes = [normalizar_ct2(lote) for lote in ler_protheus(filename, 'CT2', tamanho_lote)]
+    
+    if not lotes:
+        return normalizar_ct2(ler_protheus(filename, 'CT2'))
+    
+    return pd.concat(lotes, ignore_index=True)
 
-# Processar filiais Tecadi
-df_tecadi = df_tecadi.rename(columns={'Filial Orig': 'Cod filial'})
+# %% [markdown]
+# ### Processamento incremental da CT2
+# 
+# Cada linha da CT2 é identificada pelo hash do seu conteúdo, calculado sobre o texto da linha (sem interpretar as colunas).
+# O estado da execução anterior fica em Output/incremental, um por arquivo da CT2 (empresa): somente as linhas novas ou
+# alteradas são lidas e tratadas novamente, as linhas removidas do arquivo saem do razão e as demais são reaproveitadas
+# já tratadas. O razão resultante fica na mesma ordem das linhas do arquivo, igual ao de uma leitura completa.
+# As etapas seguintes (regras, rateios e arquivo de importação) continuam sendo feitas sobre o razão completo.
 
-# Processar filiais Dagnoni
-df_dagnoni = df_dagnoni.rename(columns={'Filial Orig': 'Cod filial'})
-df_dagnoni['Centro de custo'] = '999999' # A Dagnoni não tem centro de custo
-df_dagnoni['Cod filial'] = 'ADM'
+# %%
+# Pasta do estado incremental (um estado por arquivo da CT2, identificado pelo nome do arquivo)
+pasta_estado_incremental = os.path.join(base_dir, 'incremental')
+
+# Lê as linhas do arquivo como texto: cabeçalho (2 linhas ignoradas + nomes das colunas) e linhas de dados não vazias
+def linhas_protheus(filename):
+    with open(filename, 'rb') as f:
+        linhas = f.read().decode('latin-1').replace('\r\n', '\n').split('\n')
+    return linhas[:3], list(filter(None, linhas[3:]))
+
+# Versão de cada linha: hash do texto + ordem de ocorrência do mesmo texto no arquivo (linhas repetidas são diferentes)
+def _versoes_linhas(linhas):
+    conteudo = pd.Series(pd.util.hash_array(np.array(linhas, dtype=object), categorize=False))
+    ocorrencia = conteudo.groupby(conteudo).cumcount()
+    return pd.util.hash_pandas_object(pd.DataFrame({'conteudo': conteudo, 'ocorrencia': ocorrencia}), index=False).to_numpy()
+
+def process_ct2_incremental(filename, tamanho_lote=ct2_tamanho_lote):
+    if pa is None:
+        return process_ct2(filename, tamanho_lote)
+    
+    cabecalho, linhas = linhas_protheus(filename)
+    if not linhas:
+        return process_ct2(filename, tamanho_lote)
+    
+    # Um campo entre aspas com quebra de linha ocupa mais de uma linha do arquivo: ler o arquivo inteiro
+    if any(linha.count('"') % 2 for linha in linhas if '"' in linha):
+        print(f"{filename} (incremental): campos com quebra de linha, arquivo lido por completo")
+        return process_ct2(filename, tamanho_lote)
+    
+    nome = os.path.splitext(os.path.basename(filename))[0]
+    caminho_linhas = os.path.join(pasta_estado_incremental, f'{nome}_linhas.parquet')
+    caminho_razao = os.path.join(pasta_estado_incremental, f'{nome}_razao.parquet')
+    caminho_versao = os.path.join(pasta_estado_incremental, f'{nome}_versao.json')
+    
+    # O estado só é reaproveitado se foi gerado com o mesmo tratamento e o mesmo cabeçalho da CT2
+    versao_tratamento = json.dumps([versao_leitura, esquemas_protheus['CT2'], colunas_chave_ct2, cabecalho[2:]], ensure_ascii=False)
+    linhas_anteriores = pd.DataFrame({'Identificacao': pd.Series(dtype='uint64'), 'Versao': pd.Series(dtype='uint64')})
+    razao_anterior = None
+    if all(os.path.exists(caminho) for caminho in [caminho_linhas, caminho_razao, caminho_versao]):
+        with open(caminho_versao, encoding='utf-8') as f:
+            if f.read() == versao_tratamento:
+                linhas_anteriores = pd.read_parquet(caminho_linhas)
+                razao_anterior = pd.read_parquet(caminho_razao)
+    
+    # Linhas inalteradas: versão já existia na execução anterior e a identificação é reaproveitada
+    versao = _versoes_linhas(linhas)
+    anterior = pd.Index(linhas_anteriores['Versao']).get_indexer(versao)
+    mudou = anterior < 0
+    posicoes_mudou = np.flatnonzero(mudou)
+    identificacao = np.zeros(len(versao), dtype='uint64')
+    identificacao[~mudou] = linhas_anteriores['Identificacao'].to_numpy()[anterior[~mudou]]
+    
+    # Ler e tratar somente as linhas novas ou alteradas, com o cabeçalho original do arquivo
+    tratados, inicio = [], 0
+    if len(posicoes_mudou):
+        texto = '\n'.join(cabecalho + [linhas[posicao] for posicao in posicoes_mudou]) + '\n'
+        lotes = ler_protheus(io.BytesIO(texto.encode('latin-1')), 'CT2', tamanho_lote, colunas_chave_ct2)
+        for lote in [lotes] if tamanho_lote is None else lotes:
+            posicoes = posicoes_mudou[inicio:inicio + len(lote)]
+            identificacao[posicoes] = pd.util.hash_pandas_object(lote[colunas_chave_ct2], index=False).to_numpy()
+            
+            tratado = normalizar_ct2(lote)
+            tratados.append(tratado.assign(_versao=versao[posicoes[tratado.index]], _posicao=posicoes[tratado.index]))
+            inicio += len(lote)
+    
+    linhas = pd.DataFrame({'Identificacao': identificacao, 'Versao': versao})
+    existia = linhas['Identificacao'].isin(linhas_anteriores['Identificacao']).to_numpy()
+    novas = int((mudou & ~existia).sum())
+    alteradas = int((mudou & existia).sum())
+    removidas = int((~linhas_anteriores['Identificacao'].isin(linhas['Identificacao'])).sum())
+    
+    # Razão = linhas inalteradas da execução anterior + linhas novas ou alteradas, na ordem das linhas do arquivo
+    mantidas = []
+    if razao_anterior is not None:
+        mantidas = razao_anterior[razao_anterior['_versao'].isin(versao[~mudou])]
+        posicao_versao = pd.Series(np.arange(len(versao)), index=versao)
+        mantidas = [mantidas.assign(_posicao=mantidas['_versao'].map(posicao_versao).to_numpy())]
+    razao = pd.concat(mantidas + tratados, ignore_index=True)
+    razao = razao.sort_values('_posicao', kind='stable', ignore_index=True).drop(columns='_posicao')
+    
+    # Gravar o estado para a próxima execução
+    os.makedirs(pasta_estado_incremental, exist_ok=True)
+    gravar_atomico(caminho_linhas, lambda temporario: linhas.to_parquet(temporario, index=False))
+    gravar_atomico(caminho_razao, lambda temporario: razao.to_parquet(temporario, index=False))
+    with open(caminho_versao, 'w', encoding='utf-8') as f:
+        f.write(versao_tratamento)
+    
+    print(f"{filename} (incremental): {novas} linha(s) nova(s), {alteradas} alterada(s) e {removidas} removida(s)")
+    return razao.drop(columns='_versao')
 
-# Concatenar preservando as filiais
-df = pd.concat([df_tecadi, df_dagnoni], ignore_index=True)
+# Função de leitura da CT2 conforme o modo configurado
+leitor_ct2 = process_ct2_incremental if ct2_incremental else process_ct2
 
 # %% [markdown]
-# ## Converter os lançamentos da SC7 (Pedidos de compra)
-# 
-# **Atenção:** Executar apenas se for necessário trazer esses lançamentos, do contrário passar para o próximo passo.
+# ## Carregar os arquivos de entrada
 
 # %%
-# Ler SA2 pulando 2 primeiras linhas
-sa2 = pd.read_csv(sa2_filename, sep=';', encoding='latin-1', quotechar='"', skiprows=2, low_memory=False)
+# Entrada da CT2 de cada empresa
+entradas_ct2 = {f'ct2_{empresa}': empresa for empresa in empresas}
+
+# Arquivos de entrada: nome -> (arquivo, função de leitura, tipo do cache, obrigatório)
+arquivos_entrada = {
+    **{nome: (empresas[empresa]['ct2'], leitor_ct2, 'CT2', True) for nome, empresa in entradas_ct2.items()},
+    'sa2':                (sa2_filename, atualizar_indice_fornecedores, None, False),
+    'sc7':                (sc7_filename, partial(ler_protheus, tabela='SC7'), 'SC7', True),
+    'plano_contas':       (plano_filename, ler_plano_contas, 'PLANO', True),
+    'rateio_patrimonial': (parametros_rateio_patrimonial_filename, ler_parametros_rateio, 'RATEIO', True),
+    'rateio_corporativo': (parametros_rateio_corporativo_filename, ler_parametros_rateio, 'RATEIO', True),
+    'ajustes':            (ajustes_gerenciais_filename, ler_ajustes_gerenciais, 'AJUSTES', False)
+}
 
-# Ler SC7 pulando 2 primeiras linhas
-sc7 = pd.read_csv(sc7_filename, sep=';', encoding='latin-1', quotechar='"', skiprows=2, low_memory=False)
+# Arquivos de referência mantidos em memória entre as execuções do modo serviço
+entradas_residentes = ['plano_contas', 'sa2', 'rateio_patrimonial', 'rateio_corporativo']
 
-# Remove linhas com dados na coluna extra e reseta o índice
-#sa2 = sa2[sa2['Unnamed: 2'].isna()].reset_index(drop=True)
+def _carregar_entrada(nome):
+    filename, leitor, tipo, _ = arquivos_entrada[nome]
+    return ler_com_cache(filename, leitor, tipo)
 
-# Remove zeros à esquerda do código do fornecedor
-sa2['Codigo'] = sa2['Codigo'].str.lstrip('0')
+# Identifica a versão de um arquivo sem lê-lo (data de modificação e tamanho)
+def assinatura_arquivo(filename):
+    status = os.stat(filename)
+    return status.st_mtime_ns, status.st_size
 
-# Filtrar na SC7 apenas aprovados e não encerrados
-sc7_aprovados_df = sc7[
-    (sc7['Ped. Encerr.'] != 'E') &
-    (sc7['Resid. Elim.'] != 'S') &
-    (sc7['Status'] == 'Aprovado')
-]
+# Contexto dos processos auxiliares (leitura da CT2 e meses do modo em lote): os processos são iniciados pelo forkserver
+# (ou spawn, onde não existe), nunca por cópia (fork) deste processo, que já tem as threads do pyarrow
+def contexto_processos():
+    return multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
 
-# Filtrar na SC7 apenas em aprovação e não encerrados
-sc7_em_aprovacao_df = sc7[
-    (sc7['Ped. Encerr.'] != 'E') &
-    (sc7['Resid. Elim.'] != 'S') &
-    (sc7['Status'] == 'B')
-]
+# Lê os arquivos informados em paralelo, preenchendo o dicionário de entradas
+def _carregar_em_paralelo(entradas, nomes):
+    if not nomes:
+        return
+    
+    # O tratamento da CT2 (textos) não libera o GIL: com 2 ou mais CT2 grandes, cada uma é tratada em um processo
+    # separado, exceto a maior, que fica neste processo para não copiar o maior resultado entre processos.
+    # No notebook, os processos não são criados
+    tamanho_minimo = ct2_tamanho_minimo_processo_mb * 1024 * 1024
+    ct2 = sorted([nome for nome in nomes if nome in entradas_ct2 and os.path.getsize(arquivos_entrada[nome][0]) >= tamanho_minimo],
+                 key=lambda nome: os.path.getsize(arquivos_entrada[nome][0]))[:-1]
+    if executando_no_notebook:
+        ct2 = []
+    
+    # As demais leituras são independentes: o pyarrow e o hash dos arquivos liberam o GIL, então threads já paralelizam a leitura
+    executor = ThreadPoolExecutor(max_workers=min(len(nomes), os.cpu_count() or 1))
+    processos = None
+    if ct2:
+        processos = ProcessPoolExecutor(max_workers=min(len(ct2), os.cpu_count() or 1), mp_context=contexto_processos())
+    
+    falha = None
+    try:
+        futuros = {processos.submit(_carregar_entrada, nome): nome for nome in ct2}
+        futuros.update({executor.submit(_carregar_entrada, nome): nome for nome in nomes if nome not in ct2})
+        for futuro in as_completed(futuros):
+            nome = futuros[futuro]
+            try:
+                entradas[nome] = futuro.result()
+            except Exception as erro:
+                falha = nome, erro
+                break
+    finally:
+        # Sem esperar as leituras em andamento: depois de uma falha, o erro é informado sem aguardar a maior CT2
+        executor.shutdown(wait=False, cancel_futures=True)
+        if processos is not None:
+            processos.shutdown(wait=False, cancel_futures=True)
+    
+    # Interromper com o nome do arquivo que falhou
+    if falha is not None:
+        nome, erro = falha
+        raise RuntimeError(f"Erro ao ler o arquivo {arquivos_entrada[nome][0]}: {erro}") from erro
+
+# Lê todos os arquivos de entrada (em paralelo, se configurado) e retorna os DataFrames tratados por nome.
+# Arquivos opcionais ausentes retornam None. Com memoria (dict), os arquivos de referência que não mudaram
+# desde a leitura anterior são reaproveitados sem nova leitura. Os arquivos em ignorar não são lidos
+# (os obrigatórios continuam sendo verificados)
+def carregar_entradas(paralelo=leitura_paralela, memoria=None, ignorar=()):
+    # Interromper antes de qualquer leitura se faltar algum arquivo obrigatório
+    faltando = [filename for filename, _, _, obrigatorio in arquivos_entrada.values() if obrigatorio and not os.path.exists(filename)]
+    if faltando:
+        raise FileNotFoundError(f"Arquivo(s) obrigatório(s) não encontrado(s): {', '.join(faltando)}")
+    
+    limpar_cache()
+    
+    entradas = dict.fromkeys(arquivos_entrada)
+    nomes = [nome for nome, (filename, _, _, _) in arquivos_entrada.items() if os.path.exists(filename) and nome not in ignorar]
+    
+    if memoria is not None:
+        assinaturas = {nome: assinatura_arquivo(arquivos_entrada[nome][0]) for nome in entradas_residentes if nome in nomes}
+        for nome in entradas_residentes:
+            if nome in memoria and memoria[nome][0] == assinaturas.get(nome):
+                entradas[nome] = memoria[nome][1]
+            else:
+                memoria.pop(nome, None)
+        nomes = [nome for nome in nomes if nome not in memoria]
+    
+    if not paralelo:
+        for nome in nomes:
+            entradas[nome] = _carregar_entrada(nome)
+    else:
+        _carregar_em_paralelo(entradas, nomes)
+    
+    if memoria is not None:
+        for nome in assinaturas:
+            memoria.setdefault(nome, (assinaturas[nome], entradas[nome]))
+    
+    return entradas
+
+# Aplica a filial e o centro de custo da empresa aos lançamentos da sua CT2
+def filiais_empresa(df, empresa):
+    cadastro = empresas[empresa]
+    df.rename(columns={'Filial Orig': 'Cod filial'}, inplace=True)
+    if cadastro['centro_custo'] is not None:
+        df['Centro de custo'] = cadastro['centro_custo']
+    if cadastro['filial'] is not None:
+        df['Cod filial'] = cadastro['filial']
+    return df
+
+# Lançamentos da CT2 de cada empresa (empresa -> DataFrame), na ordem do cadastro, como partes do razão
+def partes_ct2(ct2_empresas):
+    return [filiais_empresa(df, empresa) for empresa, df in ct2_empresas.items()]
+
+# %% [markdown]
+# ## Converter os lançamentos da SC7 (Pedidos de compra)
+# 
+# **Atenção:** Executar apenas se for necessário trazer esses lançamentos, do contrário passar para o próximo passo.
 
-# Remove zeros à esquerda do código do fornecedor
-sc7_aprovados_df['Fornecedor'] = sc7_aprovados_df['Fornecedor'].astype(str).str.lstrip('0')
-sc7_em_aprovacao_df['Fornecedor'] = sc7_em_aprovacao_df['Fornecedor'].astype(str).str.lstrip('0')
+# %%
+# Status da SC7 considerados e a descrição usada no histórico do lançamento
+status_sc7 = {
+    status: descricao
+    for status, descricao, considerar in [
+        ('Aprovado', 'aprovado e não recebido', sc7_aprovados),
+        ('B', 'em aprovação', sc7_em_aprovacao)
+    ]
+    if considerar
+}
 
 # Define quais as TES que tomam crédito de Pis e Cofins
 def tes_credito():
@@ -210,632 +1200,1235 @@ def tes_credito():
         '095', '096', '097', '098', '105', '130', '133', '209', '216', '217',
         '218', '48B', '48C')
 
-# Função para formatar número do pedido
-def formatar_pedido(filial, numero):
-   return f"{filial}/{str(numero).zfill(6)}"
-
-# Criar lançamentos de débito da SC7 (aprovados)
-if sc7_aprovados:
-    if not sc7_aprovados_df.empty:  # Verifica se o DataFrame não está vazio
-        df_sc7_aprovados = pd.DataFrame({
-            'Conta': sc7_aprovados_df['Cta Contabil'],
-            'Valor': sc7_aprovados_df['Vlr.Total'].str.replace(',', '.').astype(float),
-            'D/C': 'D',
-            'Hist Lanc': 'Pedido ' + sc7_aprovados_df.apply(lambda x: formatar_pedido(x['Filial'], x['Numero PC']), axis=1) + ' aprovado e não recebido.',
-            'Data Lcto': sc7_aprovados_df['Dt. Entrega'],
-            'Centro de custo': sc7_aprovados_df['Centro Custo'].apply(lambda x: f'0{int(x)}' if pd.notnull(x) else ''),
-            'Cod filial': sc7_aprovados_df['Filial'],
-            'Obs': sc7_aprovados_df['Fornecedor'].map(dict(zip(sa2['Codigo'], sa2['Razao Social']))).fillna('Fornecedor não encontrado')
-        })
-
-        # Criar lançamentos de crédito para Pis e Cofins (aprovados)
-        df_sc7_piscofins_aprovados = df_sc7_aprovados[sc7_aprovados_df['Tipo Entrada'].isin(tes_credito())].copy()
-        df_sc7_piscofins_aprovados['D/C'] = 'C'
-        df_sc7_piscofins_aprovados['Valor'] = (df_sc7_piscofins_aprovados['Valor'] * 0.0925).round(2)
-        df_sc7_piscofins_aprovados = df_sc7_piscofins_aprovados[df_sc7_piscofins_aprovados['Valor'] != 0]
-        df_sc7_piscofins_aprovados['Hist Lanc'] = 'Créd. de Pis e Cofins ref. pedido ' + sc7_aprovados_df[sc7_aprovados_df['Tipo Entrada'].isin(tes_credito())].apply(lambda x: formatar_pedido(x['Filial'], x['Numero PC']), axis=1) + ' aprovado e não recebido.'
-
-        # Tratar conta contábil e centro de custo (aprovados)
-        for df in [df_sc7_aprovados, df_sc7_piscofins_aprovados]:
-            df['Conta'] = df['Conta'].astype(str)
-    else:
-        # Se o DataFrame estiver vazio, cria um DataFrame vazio com as colunas necessárias
-        df_sc7_aprovados = pd.DataFrame(columns=['Conta', 'Valor', 'D/C', 'Hist Lanc', 'Data Lcto', 'Centro de custo', 'Cod filial', 'Obs'])
-        df_sc7_piscofins_aprovados = pd.DataFrame(columns=['Conta', 'Valor', 'D/C', 'Hist Lanc', 'Data Lcto', 'Centro de custo', 'Cod filial', 'Obs'])
-
-# Criar lançamentos de débito da SC7 (em aprovação)
-if sc7_em_aprovacao:
-    if not sc7_em_aprovacao_df.empty:  # Verifica se o DataFrame não está vazio
-        df_sc7_em_aprovacao = pd.DataFrame({
-            'Conta': sc7_em_aprovacao_df['Cta Contabil'],
-            'Valor': sc7_em_aprovacao_df['Vlr.Total'].str.replace(',', '.').astype(float),
-            'D/C': 'D',
-            'Hist Lanc': 'Pedido ' + sc7_em_aprovacao_df.apply(lambda x: formatar_pedido(x['Filial'], x['Numero PC']), axis=1) + ' em aprovação.',
-            'Data Lcto': sc7_em_aprovacao_df['Dt. Entrega'],
-            'Centro de custo': sc7_em_aprovacao_df['Centro Custo'].apply(lambda x: f'0{int(x)}' if pd.notnull(x) else ''),
-            'Cod filial': sc7_em_aprovacao_df['Filial'],
-            'Obs': sc7_em_aprovacao_df['Fornecedor'].map(dict(zip(sa2['Codigo'], sa2['Razao Social']))).fillna('Fornecedor não encontrado')
-        })
-
-        # Criar lançamentos de crédito para Pis e Cofins (em aprovação)
-        df_sc7_piscofins_em_aprovacao = df_sc7_em_aprovacao[sc7_em_aprovacao_df['Tipo Entrada'].isin(tes_credito())].copy()
-        df_sc7_piscofins_em_aprovacao['D/C'] = 'C'
-        df_sc7_piscofins_em_aprovacao['Valor'] = (df_sc7_piscofins_em_aprovacao['Valor'] * 0.0925).round(2)
-        df_sc7_piscofins_em_aprovacao = df_sc7_piscofins_em_aprovacao[df_sc7_piscofins_em_aprovacao['Valor'] != 0]
-        df_sc7_piscofins_em_aprovacao['Hist Lanc'] = 'Créd. de Pis e Cofins ref. pedido ' + sc7_em_aprovacao_df[sc7_em_aprovacao_df['Tipo Entrada'].isin(tes_credito())].apply(lambda x: formatar_pedido(x['Filial'], x['Numero PC']), axis=1) + ' em aprovação.'
-
-        # Tratar conta contábil e centro de custo (em aprovação)
-        for df in [df_sc7_em_aprovacao, df_sc7_piscofins_em_aprovacao]:
-            df['Conta'] = df['Conta'].astype(str)
-    else:
-        # Se o DataFrame estiver vazio, cria um DataFrame vazio com as colunas necessárias
-        df_sc7_em_aprovacao = pd.DataFrame(columns=['Conta', 'Valor', 'D/C', 'Hist Lanc', 'Data Lcto', 'Centro de custo', 'Cod filial', 'Obs'])
-        df_sc7_piscofins_em_aprovacao = pd.DataFrame(columns=['Conta', 'Valor', 'D/C', 'Hist Lanc', 'Data Lcto', 'Centro de custo', 'Cod Filial', 'Obs'])
+# Gera, em uma única passada, os lançamentos de débito dos pedidos e os créditos de Pis e Cofins
+# para todos os status considerados
+def gerar_lancamentos_sc7(sc7, sa2, status):
+    # Filtrar na SC7 apenas os status considerados e não encerrados
+    pedidos = sc7[
+        (sc7['Ped. Encerr.'] != 'E') &
+        (sc7['Resid. Elim.'] != 'S') &
+        (sc7['Status'].isin(list(status)))
+    ]
+    
+    numero_pedido = pedidos['Filial'] + '/' + pedidos['Numero PC'].str.zfill(6)
+    descricao_status = pedidos['Status'].map(status)
+    
+    # Nome do fornecedor pelo código (em caso de código repetido na SA2, vale o último)
+    fornecedores = sa2.drop_duplicates('Codigo', keep='last').set_index('Codigo')['Razao Social']
+    
+    # Lançamentos de débito
+    debitos = pd.DataFrame({
+        'Conta': pedidos['Cta Contabil'],
+        'Valor': pedidos['Vlr.Total'],
+        'D/C': 'D',
+        'Hist Lanc': 'Pedido ' + numero_pedido + ' ' + descricao_status + '.',
+        'Data Lcto': pedidos['Dt. Entrega'],
+        'Centro de custo': pedidos['Centro Custo'],
+        'Cod filial': pedidos['Filial'],
+        'Obs': pedidos['Fornecedor'].map(fornecedores).fillna('Fornecedor não encontrado')
+    })
+    
+    # Lançamentos de crédito de Pis e Cofins para as TES que tomam crédito
+    toma_credito = pedidos['Tipo Entrada'].isin(tes_credito())
+    creditos = debitos[toma_credito].assign(**{
+        'Valor': arredondar_centavos(debitos.loc[toma_credito, 'Valor'] * round(aliquota_pis + aliquota_cofins, 6)),
+        'D/C': 'C',
+        'Hist Lanc': 'Créd. de Pis e Cofins ref. pedido ' + numero_pedido[toma_credito] + ' ' + descricao_status[toma_credito] + '.'
+    })
+    creditos = creditos[creditos['Valor'] != 0]
+    
+    return pd.concat([debitos, creditos], ignore_index=True)
 
-# Concatenar os dados da SC7 com DataFrame principal
-df_list = [df_tecadi, df_dagnoni]
-if sc7_aprovados:
-    df_list.extend([df_sc7_aprovados, df_sc7_piscofins_aprovados])
-if sc7_em_aprovacao:
-    df_list.extend([df_sc7_em_aprovacao, df_sc7_piscofins_em_aprovacao])
+# Lançamentos da SC7 com os arquivos de entrada já lidos (os códigos de fornecedor já chegam sem os zeros à esquerda).
+# A SA2 é opcional: sem a SA2.csv, os nomes vêm do índice de fornecedores das exportações anteriores
+def lancamentos_sc7(entradas):
+    sa2 = entradas['sa2'] if entradas['sa2'] is not None else ler_indice_fornecedores()[0]
+    return gerar_lancamentos_sc7(entradas['sc7'], sa2, status_sc7)
 
-df_list = [df for df in df_list if not df.empty]
-df = pd.concat(df_list, ignore_index=True, copy=True)
+# Monta o razão com os lançamentos da CT2 e da SC7 de todos os períodos dos arquivos de entrada
+def montar_razao(entradas, perfil=None):
+    perfil = perfil or PerfilExecucao(ativo=False)
+    
+    ct2_empresas = {empresa: entradas[nome] for nome, empresa in entradas_ct2.items()}
+    with perfil.etapa('Consolidação da CT2', list(ct2_empresas.values())) as medicao:
+        ct2 = medicao['saida'] = partes_ct2(ct2_empresas)
+    
+    with perfil.etapa('Lançamentos da SC7', entradas['sc7']) as medicao:
+        df_sc7 = medicao['saida'] = lancamentos_sc7(entradas)
+    
+    # A CT2 de cada empresa e os lançamentos da SC7 entram no razão como partes separadas, sem concatenação
+    return RazaoLancamentos(ct2 + [df_sc7])
 
 # %% [markdown]
 # ## Gerar os lançamentos de ajustes gerenciais e os ajustes de contas contábeis e centros de custo
 
 # %%
-# Data mais recente
-data_mais_recente = df['Data Lcto'].max()
+# Gera os lançamentos dos ajustes gerenciais na data informada
+# (a diferença entre débitos e créditos dos ajustes é verificada pela validação)
+def gerar_ajustes_gerenciais(ajustes, data_lancamento):
+    centro_custo = ajustes['Centro de custo'].apply(lambda x: f'0{int(x)}' if pd.notnull(x) else '')
+    
+    return pd.DataFrame({
+        'Conta': ajustes['Conta'],
+        'Valor': ajustes['Valor'],
+        'D/C': ajustes['D/C'],
+        'Hist Lanc': '(Ajuste gerencial) ' + ajustes['Hist Lanc'],
+        'Data Lcto': data_lancamento,
+        'Centro de custo': centro_custo,
+        'Cod filial': ajustes['Filial Orig'],
+        'Obs': ajustes.get('Obs', '')
+    })
+
+# Ajustes de filial das contas 7, 8 e 9 e da conta 4101010201
+def ajustar_filiais(razao):
+    # Contas e filiais em colunas categóricas, com a classe e o grupo das contas
+    razao.codificar()
+    
+    # Contas 7, 8 e 9 para a filial 101 (exceto ADM) e conta 4101010201 da 101 para a 107TR (fase 'filiais' das regras)
+    razao.aplicar(partial(aplicar_regras, fase='filiais'))
+    return razao
 
-# Ajustes gerenciais
-try:
-    ajustes = pd.read_excel(ajustes_gerenciais_filename)
+# %% [markdown]
+# ## Índice de saldos
+# 
+# Os saldos com sinal (débitos positivos, créditos negativos) são agregados uma única vez por filial, classe
+# (primeiro dígito) e conta. As consultas das etapas de rateio e impostos percorrem apenas os grupos do índice,
+# e não todas as linhas do razão. O índice é atualizado a cada lançamento acrescentado, movido ou removido.
+
+# %%
+# Valor com sinal: débitos positivos e créditos negativos
+def valor_assinado(df):
+    return df['Valor'].where(df['D/C'] == 'D', -df['Valor'])
+
+class IndiceSaldos:
+    def __init__(self, razao):
+        partes = partes_razao(razao)
+        self.saldos = self._agregar(partes[0])
+        for parte in partes[1:]:
+            self.adicionar(parte)
     
-    if not ajustes.empty:
-        soma_debitos = ajustes[ajustes['D/C'] == 'D']['Valor'].sum()
-        soma_creditos = ajustes[ajustes['D/C'] == 'C']['Valor'].sum()
+    @staticmethod
+    def _agregar(df):
+        saldos = df['Valor assinado'].groupby([df['Cod filial'], df['Classe'], df['Conta']], sort=False, observed=True).sum()
         
-        if soma_debitos != soma_creditos:
-            resposta = input(f"ATENÇÃO: Diferença de {abs(soma_debitos - soma_creditos):.2f} entre débitos e créditos. Continuar? (S/N): ")
-            if resposta.upper() != 'S':
-                raise SystemExit("Processo interrompido pelo usuário.")
+        # Filiais e contas do índice em texto, para alinhar os saldos de lançamentos com categorias diferentes
+        niveis = [saldos.index.get_level_values(nome) for nome in saldos.index.names]
+        saldos.index = pd.MultiIndex.from_arrays(
+            [np.asarray(nivel, dtype=object) if nome != 'Classe' else nivel.astype('int8') for nome, nivel in zip(saldos.index.names, niveis)],
+            names=saldos.index.names
+        )
+        return saldos
+    
+    # Soma (ou subtrai, com sinal=-1) os saldos dos lançamentos ao índice
+    def adicionar(self, df, sinal=1):
+        if not df.empty:
+            self.saldos = self.saldos.add(sinal * self._agregar(df), fill_value=0).astype('int64')
+    
+    def remover(self, df):
+        self.adicionar(df, sinal=-1)
+    
+    # Saldo da filial, opcionalmente restrito a contas que começam com os prefixos e/ou a uma lista de contas
+    def saldo(self, filial, prefixos=None, contas=None):
+        saldos = self.saldos
+        if filial not in saldos.index.get_level_values('Cod filial'):
+            return 0
         
-        ajustes['Conta'] = ajustes['Conta'].astype(str)
-        ajustes['Centro de custo'] = ajustes['Centro de custo'].astype(str)
-        ajustes['Filial Orig'] = ajustes['Filial Orig'].astype(str)
-        ajustes['Centro de custo'] = ajustes['Centro de custo'].apply(lambda x: f'0{int(x)}' if pd.notnull(x) else '')        
+        saldos = saldos.xs(filial, level='Cod filial')
+        if prefixos is not None:
+            prefixos = tuple(prefixos)
+            classes = {int(prefixo[:1]) for prefixo in prefixos}
+            saldos = saldos[saldos.index.get_level_values('Classe').isin(classes)]
+            saldos = saldos[saldos.index.get_level_values('Conta').str.startswith(prefixos)]
+        if contas is not None:
+            saldos = saldos[saldos.index.get_level_values('Conta').isin(contas)]
         
-        ajustes_df = pd.DataFrame({
-            'Conta': ajustes['Conta'],
-            'Valor': ajustes['Valor'],
-            'D/C': ajustes['D/C'],
-            'Hist Lanc': '(Ajuste gerencial) ' + ajustes['Hist Lanc'],
-            'Data Lcto': data_mais_recente,
-            'Centro de custo': ajustes['Centro de custo'],
-            'Cod filial': ajustes['Filial Orig'],
-            'Obs': ajustes.get('Obs', '')
-        })
+        return saldos.sum()
+    
+    # Saldo de cada uma das filiais, com os mesmos filtros de saldo(), em uma única passada pelos grupos do índice
+    def saldos_por_filial(self, filiais, prefixos=None, contas=None):
+        saldos = self.saldos
+        filtro = saldos.index.get_level_values('Cod filial').isin(filiais)
+        if prefixos is not None:
+            filtro &= saldos.index.get_level_values('Conta').str.startswith(tuple(prefixos))
+        if contas is not None:
+            filtro &= saldos.index.get_level_values('Conta').isin(contas)
         
-        df = pd.concat([df, ajustes_df], ignore_index=True)
+        return saldos[filtro].groupby(level='Cod filial').sum().reindex(filiais, fill_value=0)
+    
+    # Saldo de cada par (filial, conta) informado, com zero para os pares sem lançamentos
+    def saldos_por_filial_conta(self, filiais, contas):
+        saldos = self.saldos
+        filtro = saldos.index.get_level_values('Cod filial').isin(filiais) & saldos.index.get_level_values('Conta').isin(contas)
+        pares = pd.MultiIndex.from_product([filiais, contas], names=['Cod filial', 'Conta'])
+        return saldos[filtro].groupby(level=['Cod filial', 'Conta']).sum().reindex(pares, fill_value=0)
+
+# %% [markdown]
+# ## Razão em partes
+# 
+# Os lançamentos gerados pelas etapas (ajustes, rateios, impostos recalculados e zeramento) não são concatenados ao
+# razão a cada etapa, o que copiaria todas as linhas do mês a cada vez: cada lote acrescentado vira uma parte do
+# razão, com as mesmas colunas e as mesmas categorias de contas e filiais. As regras e os filtros das etapas são
+# aplicados em cada parte, os totais (balancete e validação) somam os grupos de cada parte, e o razão só é montado
+# uma vez, já com as colunas e os tipos do arquivo de importação.
+
+# %%
+# As partes passam a pertencer ao razão: as etapas alteram as suas colunas no lugar
+class RazaoLancamentos:
+    def __init__(self, partes):
+        self.partes = [parte for parte in partes if not parte.empty] or list(partes[:1])
+    
+    # Contas e filiais de todas as partes em colunas categóricas com as mesmas categorias
+    def codificar(self):
+        categorias = categorias_contas(self.partes)
+        self.partes = [codificar_contas(parte, categorias) for parte in self.partes]
+    
+    # Aplica a função (regras ou filtros de uma etapa, que recebe e retorna um DataFrame) em cada parte.
+    # As partes que ficarem vazias são descartadas
+    def aplicar(self, funcao):
+        partes = [funcao(parte) for parte in self.partes]
+        self.partes = [parte for parte in partes if not parte.empty] or partes[:1]
+    
+    # Acrescenta lançamentos ao razão como uma nova parte, calculando o valor com sinal e mantendo o índice de
+    # saldos atualizado
+    def acrescentar(self, novos, indice):
+        if novos.empty:
+            return
         
-except FileNotFoundError:
-    pass
+        novos['Valor assinado'] = valor_assinado(novos)
+        categorias = {coluna: self.partes[0][coluna].cat.categories for coluna in ['Conta', 'Cod filial']}
+        if all(pd.Index(pd.unique(novos[coluna])).isin(categorias[coluna]).all() for coluna in categorias):
+            self.partes.append(codificar_contas(novos, categorias))
+        else:
+            # Conta ou filial fora das categorias do razão: todas as partes passam a ter as novas categorias
+            self.partes.append(novos)
+            self.codificar()
+        indice.adicionar(self.partes[-1])
+    
+    # Monta o razão em um único DataFrame, uma coluna por vez: colunas é um dicionário nome -> função que recebe uma
+    # parte e retorna os valores da coluna, e tipos é o tipo de cada coluna
+    def materializar(self, colunas, tipos):
+        return pd.DataFrame({
+            nome: np.concatenate([np.asarray(funcao(parte), dtype=tipos[nome]) for parte in self.partes])
+            for nome, funcao in colunas.items()
+        }, copy=False)
+
+# Partes do razão (um DataFrame é um razão de uma única parte)
+def partes_razao(razao):
+    return razao.partes if isinstance(razao, RazaoLancamentos) else [razao]
+
+# Soma os valores (função que recebe uma parte e retorna uma Series ou DataFrame) por grupo das chaves em todas as
+# partes do razão: um groupby por parte, com os grupos das partes combinados em seguida
+def somar_por_grupo(razao, valores, chaves):
+    somas = [valores(parte).groupby([parte[chave] for chave in chaves], observed=True).sum() for parte in partes_razao(razao)]
+    if len(somas) == 1:
+        return somas[0]
+    return pd.concat(somas).groupby(level=list(range(len(chaves))), observed=True).sum()
 
-# Migrar os lançamentos das contas que começam com 7, 8 ou 9 para a filial 101, exceto quando for ADM
-df.loc[(df['Conta'].str.startswith(('7', '8', '9'))) & (df['Cod filial'] != 'ADM'), 'Cod filial'] = '101'
+# %% [markdown]
+# ## Motor de rateio
+# 
+# Cada regra de rateio distribui o saldo de um ou mais pools da filial de origem entre as filiais de destino,
+# conforme o percentual do mês nos parâmetros de rateio. Para cada filial de destino é gerado o lançamento
+# na filial e o lançamento inverso na filial de contrapartida.
 
-# Garantir que as colunas sejam do tipo string (caso não sejam)
-df['Conta'] = df['Conta'].astype(str)
-df['Cod filial'] = df['Cod filial'].astype(str)
+# %%
+# Saldo (débitos positivos, créditos negativos) dos lançamentos da filial que atendem o filtro do pool
+def saldo_pool(indice, filial, pool):
+    return indice.saldo(filial, prefixos=pool.get('prefixos'), contas=pool.get('contas'))
+
+# Percentual de rateio de cada linha dos parâmetros para o mês de referência
+def percentuais_rateio(parametros, regra, data_ref):
+    coluna_ref = pd.Timestamp(data_ref.year, data_ref.month, 1)
+    valores_mes = parametros[coluna_ref].fillna(0)
+    
+    # Parâmetros informados em valores absolutos são divididos pelo total do mês
+    if regra['percentual_sobre_total']:
+        return valores_mes / valores_mes[parametros['Cod filial'] == 'TOTAL'].values[0]
+    
+    return valores_mes
 
-# Ajuste para a conta 4101010201 quando a filial for 101
-df.loc[
-    (df['Cod filial'] == '101') & 
-    (df['Conta'] == '4101010201'), 
-    'Cod filial'
-] = '107TR'
+# Gera os lançamentos de rateio (destino e contrapartida) de todos os pools da regra: saldo dos pools x percentuais das filiais,
+# distribuído pelo maior resto
+def gerar_rateio(indice, parametros, regra, data_lancamento):
+    percentuais = percentuais_rateio(parametros, regra, pd.to_datetime(data_lancamento))
+    
+    destinos = ~parametros['Cod filial'].isin(['TOTAL', regra['filial_origem']])
+    filiais_destino = parametros.loc[destinos, 'Cod filial'].to_numpy()
+    nomes_destino = parametros.loc[destinos, 'Filial'].to_numpy()
+    percentuais = percentuais[destinos].to_numpy(dtype=float)
+    
+    pools = regra['pools']
+    saldos = np.array([saldo_pool(indice, regra['filial_origem'], pool) for pool in pools], dtype='int64')
+    
+    # Matriz pools x filiais com o valor rateado
+    valores = ratear_centavos(saldos, percentuais).ravel()
+    quantidade_filiais = len(filiais_destino)
+    
+    destino = pd.DataFrame({
+        'Conta': np.repeat([pool['conta'] for pool in pools], quantidade_filiais),
+        'Valor': np.abs(valores),
+        'D/C': np.where(valores > 0, 'D', 'C'),
+        'Hist Lanc': [
+            pool['historico'].format(filial=nome, percentual=percentual * 100)
+            for pool in pools
+            for nome, percentual in zip(nomes_destino, percentuais)
+        ],
+        'Data Lcto': data_lancamento,
+        'Centro de custo': '999999',
+        'Cod filial': np.tile(filiais_destino, len(pools)),
+        'Obs': regra['obs']
+    })
+    
+    # Lançamento inverso na filial de contrapartida
+    contrapartida = destino.assign(**{
+        'D/C': np.where(valores > 0, 'C', 'D'),
+        'Cod filial': regra['filial_contrapartida'],
+        'Obs': regra['obs_contrapartida']
+    })
+    
+    manter = valores != 0
+    return pd.concat([destino[manter], contrapartida[manter]], ignore_index=True)
 
 # %% [markdown]
 # ## Gerar o rateio da patrimonial (Dagnoni) nas unidades operacionais
 
-# Ler arquivo de parâmetros de rateio 
-rateio_patrimonial = pd.read_excel(parametros_rateio_patrimonial_filename)
-
-# Extrair mês e ano da data_mais_recente
-data_ref = pd.to_datetime(data_mais_recente)
-coluna_ref = pd.to_datetime(f"{data_ref.year}-{data_ref.month}-01")
-
-# Calcular percentuais de rateio
-valores_mes = rateio_patrimonial[coluna_ref].fillna(0)
-total_mes = valores_mes[rateio_patrimonial['Cod filial'] == 'TOTAL'].values[0]
-percentuais = valores_mes / total_mes
-
-# Soma todos os lançamentos das contas 3, 4, 5, 6, 7, 8 e 9 da filial ADM
-lancamentos_adm = df[
-   (df['Cod filial'] == 'ADM') & 
-   (df['Conta'].str.match(r'^[3456789]')) &
-   (df['Valor'] != 0)
-]
-valor_total = sum(lancamentos_adm['Valor'].where(lancamentos_adm['D/C'] == 'D', -lancamentos_adm['Valor']))
-
-# Soma todos os lançamentos das contas de depreciação
-contas_depreciacao= ['6101010231', '5201010115', '5101010112', '6101010110']
-lancamentos_adm_2 = df[
-   (df['Cod filial'] == 'ADM') & 
-   (df['Conta'].isin(contas_depreciacao)) &
-   (df['Valor'] != 0)
-]
-
-valor_total_2 = sum(lancamentos_adm_2['Valor'].where(lancamentos_adm_2['D/C'] == 'D', -lancamentos_adm_2['Valor']))
-
-# Soma todos os lançamentos das contas 7, 8 e 9 da filial ADM
-lancamentos_adm_3 = df[
-    (df['Cod filial'] == 'ADM') & 
-    (df['Conta'].str.match(r'^[789]')) &
-    (df['Valor'] != 0)
-]
-valor_total_3 = sum(lancamentos_adm_3['Valor'].where(lancamentos_adm_3['D/C'] == 'D', -lancamentos_adm_3['Valor']))
-
-novos_lancamentos = []
-
-# Processar ambos os conjuntos
-for _, row in rateio_patrimonial.iterrows():
-   if row['Cod filial'] not in ['TOTAL', 'ADM']:
-       # Lançamentos na 5301010901 - Resultado da equivalência patrimonial (Dagnoni)
-       valor_rateio = valor_total * percentuais[_]
-       if valor_rateio != 0:
-           # Lançamento na filial destino
-           novos_lancamentos.extend([
-               {
-                   'Conta': '5301010901',
-                   'Valor': abs(valor_rateio),
-                   'D/C': 'D' if valor_rateio > 0 else 'C',
-                   'Hist Lanc': f'(Rateio patrimonial) Rateio da patrimonial para a filial {row["Filial"]}',
-                   'Data Lcto': data_mais_recente,
-                   'Centro de custo': '999999',
-                   'Cod filial': row['Cod filial'],
-                   'Obs': 'Lançamento automático'
-               }
-           ])
-           
-           # Lançamento inverso na filial ADM
-           novos_lancamentos.extend([
-               {
-                   'Conta': '5301010901',
-                   'Valor': abs(valor_rateio),
-                   'D/C': 'C' if valor_rateio > 0 else 'D',  # Invertido
-                   'Hist Lanc': f'(Rateio patrimonial) Rateio da patrimonial para a filial {row["Filial"]}',
-                   'Data Lcto': data_mais_recente,
-                   'Centro de custo': '999999',
-                   'Cod filial': 'ADM',  # Sempre ADM
-                   'Obs': 'Lançamento automático - contrapartida'
-               }
-           ])
-       
-       # Lançamentos na 2303010998 - ( - ) Depreciação / Amortização (Rateio patrimonial)
-       valor_rateio_2 = valor_total_2 * percentuais[_]
-       if valor_rateio_2 != 0:
-           # Lançamento na filial destino
-           novos_lancamentos.extend([
-               {
-                   'Conta': '2303010998',
-                   'Valor': abs(valor_rateio_2),
-                   'D/C': 'D' if valor_rateio_2 > 0 else 'C',
-                   'Hist Lanc': f'(Rateio patrimonial) Rateio da patrimonial para a filial {row["Filial"]}',
-                   'Data Lcto': data_mais_recente,
-                   'Centro de custo': '999999',
-                   'Cod filial': row['Cod filial'],
-                   'Obs': 'Lançamento automático'
-               }
-           ])
-           
-           # Lançamento inverso na filial ADM
-           novos_lancamentos.extend([
-               {
-                   'Conta': '2303010998',
-                   'Valor': abs(valor_rateio_2),
-                   'D/C': 'C' if valor_rateio_2 > 0 else 'D',  # Invertido
-                   'Hist Lanc': f'(Rateio patrimonial) Rateio da patrimonial para a filial {row["Filial"]}',
-                   'Data Lcto': data_mais_recente,
-                   'Centro de custo': '999999',
-                   'Cod filial': 'ADM',  # Sempre ADM
-                   'Obs': 'Lançamento automático - contrapartida'
-               }
-           ])
-        
-        # Lançamentos na 2303010997 - ( - ) Resultado financeiro / IR / CSLL (Rateio patrimonial)
-       valor_rateio_3 = valor_total_3 * percentuais[_]
-       if valor_rateio_3 != 0:
-           # Lançamento na filial destino
-           novos_lancamentos.extend([
-               {
-                   'Conta': '2303010997',
-                   'Valor': abs(valor_rateio_3),
-                   'D/C': 'D' if valor_rateio_3 > 0 else 'C',
-                   'Hist Lanc': f'(Rateio patrimonial) Rateio da patrimonial para a filial {row["Filial"]}',
-                   'Data Lcto': data_mais_recente,
-                   'Centro de custo': '999999',
-                   'Cod filial': row['Cod filial'],
-                   'Obs': 'Lançamento automático'
-               }
-           ])
-           
-           # Lançamento inverso na filial ADM
-           novos_lancamentos.extend([
-               {
-                   'Conta': '2303010997',
-                   'Valor': abs(valor_rateio_3),
-                   'D/C': 'C' if valor_rateio_3 > 0 else 'D',  # Invertido
-                   'Hist Lanc': f'(Rateio patrimonial) Rateio da patrimonial para a filial {row["Filial"]}',
-                   'Data Lcto': data_mais_recente,
-                   'Centro de custo': '999999',
-                   'Cod filial': 'ADM',  # Sempre ADM
-                   'Obs': 'Lançamento automático - contrapartida'
-               }
-           ])
-
-# Adicionar novos lançamentos ao DataFrame principal
-if novos_lancamentos:
-   df_rateio = pd.DataFrame(novos_lancamentos)
-   df = pd.concat([df, df_rateio], ignore_index=True)
+# %%
+regra_rateio_patrimonial = {
+    'filial_origem': 'ADM',
+    'filial_contrapartida': 'ADM',
+    'percentual_sobre_total': True,
+    'obs': 'Lançamento automático',
+    'obs_contrapartida': 'Lançamento automático - contrapartida',
+    'pools': [
+        # 5301010901 - Resultado da equivalência patrimonial (Dagnoni): contas 3, 4, 5, 6, 7, 8 e 9
+        {
+            'conta': '5301010901',
+            'prefixos': ['3', '4', '5', '6', '7', '8', '9'],
+            'historico': '(Rateio patrimonial) Rateio da patrimonial para a filial {filial}'
+        },
+        # 2303010998 - ( - ) Depreciação / Amortização (Rateio patrimonial): contas de depreciação
+        {
+            'conta': '2303010998',
+            'contas': ['6101010231', '5201010115', '5101010112', '6101010110'],
+            'historico': '(Rateio patrimonial) Rateio da patrimonial para a filial {filial}'
+        },
+        # 2303010997 - ( - ) Resultado financeiro / IR / CSLL (Rateio patrimonial): contas 7, 8 e 9
+        {
+            'conta': '2303010997',
+            'prefixos': ['7', '8', '9'],
+            'historico': '(Rateio patrimonial) Rateio da patrimonial para a filial {filial}'
+        }
+    ]
+}
 
 # %% [markdown]
 # ## Gerar o rateio do corporativo nas filiais
 
 # %%
-# Ler arquivo de parâmetros de rateio 
-rateio_corporativo = pd.read_excel(parametros_rateio_corporativo_filename)
-
-# Extrair mês e ano da data_mais_recente
-data_ref = pd.to_datetime(data_mais_recente)
-coluna_ref = pd.to_datetime(f"{data_ref.year}-{data_ref.month}-01")
-
-# Busca o percentual de rateio para cada filial
-valores_mes = rateio_corporativo[coluna_ref].fillna(0)
-percentuais = valores_mes
-
-# Soma todos os lançamentos das contas 3, 4, 5, 6 da filial 101
-lancamentos_corporativo = df[
-   (df['Cod filial'].astype(str) == '101') & 
-   (df['Conta'].str.match(r'^[3456]'))
-]
-valor_total = sum(lancamentos_corporativo['Valor'].where(lancamentos_corporativo['D/C'] == 'D', -lancamentos_corporativo['Valor']))
-
-# Soma todos os lançamentos das contas de depreciação
-contas_depreciacao= ['6101010231', '5201010115', '5101010112']
-lancamentos_corporativo_2 = df[
-   (df['Cod filial'].astype(str) == '101') & 
-   (df['Conta'].isin(['6101010231', '5201010115', '5101010112']))
-]
-
-valor_total_2 = sum(lancamentos_corporativo_2['Valor'].where(lancamentos_corporativo_2['D/C'] == 'D', -lancamentos_corporativo_2['Valor']))
-
-novos_lancamentos = []
-
-# Processar ambos os conjuntos
-for _, row in rateio_corporativo.iterrows():
-   if row['Cod filial'] not in ['TOTAL', '101']:
-       # Lançamentos na 5301010902 - Despesas corporativas
-       valor_rateio = valor_total * percentuais[_]
-       if valor_rateio != 0:
-           novos_lancamentos.extend([
-               {
-                   'Conta': '5301010902',
-                   'Valor': abs(valor_rateio),
-                   'D/C': 'D' if valor_rateio > 0 else 'C',
-                   'Hist Lanc': f'(Rateio corporativo) {(percentuais[_]*100):.2f}% - {row["Filial"]}',
-                   'Data Lcto': data_mais_recente,
-                   'Centro de custo': '999999',
-                   'Cod filial': row['Cod filial'],
-                   'Obs': 'Lançamento automático'
-               },
-               {
-                   'Conta': '5301010902',
-                   'Valor': abs(valor_rateio),
-                   'D/C': 'C' if valor_rateio > 0 else 'D',
-                   'Hist Lanc': f'(Rateio corporativo) {(percentuais[_]*100):.2f}% - {row["Filial"]}',
-                   'Data Lcto': data_mais_recente,
-                   'Centro de custo': '999999',
-                   'Cod filial': '101',
-                   'Obs': 'Lançamento automático'
-               }
-           ])
-       
-       # Lançamentos na 2303010996 - ( - ) Depreciação e amortização (Rateio corporativo)
-       valor_rateio_2 = valor_total_2 * percentuais[_]
-       if valor_rateio_2 != 0:
-           novos_lancamentos.extend([
-               {
-                   'Conta': '2303010996',
-                   'Valor': abs(valor_rateio_2),
-                   'D/C': 'D' if valor_rateio_2 > 0 else 'C',
-                   'Hist Lanc': f'(Rateio corporativo) {(percentuais[_]*100):.2f}% da depreciação do corporativo - {row["Filial"]}',
-                   'Data Lcto': data_mais_recente,
-                   'Centro de custo': '999999',
-                   'Cod filial': row['Cod filial'],
-                   'Obs': 'Lançamento automático'
-               },
-               {
-                   'Conta': '2303010996',
-                   'Valor': abs(valor_rateio_2),
-                   'D/C': 'C' if valor_rateio_2 > 0 else 'D',
-                   'Hist Lanc': f'(Rateio corporativo) {(percentuais[_]*100):.2f}% da depreciação do corporativo - {row["Filial"]}',
-                   'Data Lcto': data_mais_recente,
-                   'Centro de custo': '999999',
-                   'Cod filial': '101',
-                   'Obs': 'Lançamento automático'
-               }
-           ])
-
-# Adicionar novos lançamentos ao DataFrame principal
-if novos_lancamentos:
-   df_rateio = pd.DataFrame(novos_lancamentos)
-   df = pd.concat([df, df_rateio], ignore_index=True)
+regra_rateio_corporativo = {
+    'filial_origem': '101',
+    'filial_contrapartida': '101',
+    'percentual_sobre_total': False,
+    'obs': 'Lançamento automático',
+    'obs_contrapartida': 'Lançamento automático',
+    'pools': [
+        # 5301010902 - Despesas corporativas: contas 3, 4, 5 e 6
+        {
+            'conta': '5301010902',
+            'prefixos': ['3', '4', '5', '6'],
+            'historico': '(Rateio corporativo) {percentual:.2f}% - {filial}'
+        },
+        # 2303010996 - ( - ) Depreciação e amortização (Rateio corporativo): contas de depreciação
+        {
+            'conta': '2303010996',
+            'contas': ['6101010231', '5201010115', '5101010112'],
+            'historico': '(Rateio corporativo) {percentual:.2f}% da depreciação do corporativo - {filial}'
+        }
+    ]
+}
 
 # %% [markdown]
 # ## Gerar a transferência das receitas e custos para a 107TR e recalcular o ISS / Pis / Cofins
 
 # %%
-# Quais filiais devem ser consideradas para transferir as contas de receita e que iniciam com 52?
-filiais_transferencia = ['103', '105', '107', '108', '109', '114', '115']
-
-# Migrar os lançamentos das contas 52 para a filial 107TR
-df.loc[(df['Cod filial'].astype(str).isin(filiais_transferencia)) & 
-      (df['Conta'].astype(str).str.startswith('52')), 'Cod filial'] = '107TR'
-
-# Migrar os lançamentos das contas de ICMS e Crédito pró-cargas
-df.loc[(df['Cod filial'].astype(str).isin(filiais_transferencia)) & 
-      (df['Conta'].isin(['4101010206', '4101010201'])), 'Cod filial'] = '107TR'
-
-# Quais contas devem ser transferidas para a filial 107TR?
-contas_transferencia = ['3101010104', '3101010105']
-
-# Calcular impostos após transferência
-novos_lancamentos = []
-
-for filial in filiais_transferencia:
-   # Identificar saldo original das contas 3 antes da transferência
-   mask_conta_3 = (
-       (df['Cod filial'].astype(str) == filial) & 
-       (df['Conta'].astype(str).str.startswith('3'))
-   )
-   saldo_original = df[mask_conta_3]['Valor'].where(
-       df[mask_conta_3]['D/C'] == 'C', 
-       -df[mask_conta_3]['Valor']
-   ).sum()
-   
-   # Identificar valor que será transferido
-   mask_transferencia = (
-       (df['Cod filial'].astype(str) == filial) & 
-       (df['Conta'].isin(contas_transferencia))
-   )
-   valor_transferir = df[mask_transferencia]['Valor'].where(
-       df[mask_transferencia]['D/C'] == 'C',
-       -df[mask_transferencia]['Valor']
-   ).sum()
-   
-   # Transferir contas para 107TR
-   df.loc[mask_transferencia, 'Cod filial'] = '107TR'
-   
-   # Calcular novos impostos
-   saldo_remanescente = saldo_original - valor_transferir
-   novo_pis = abs(saldo_remanescente * aliquota_pis)
-   novo_cofins = abs(saldo_remanescente * aliquota_cofins)
-   novo_iss = abs(saldo_remanescente * aliquota_iss[filial])
-   
-   # Processar cada imposto
-   impostos = {
-       '4101010202': {'valor': novo_pis, 'nome': 'Pis'},
-       '4101010203': {'valor': novo_cofins, 'nome': 'Cofins'},
-       '4101010204': {'valor': novo_iss, 'nome': 'ISS'}
-   }
-   
-   for conta, info in impostos.items():
-       # Remover lançamentos antigos
-       mask_imposto = (
-           (df['Cod filial'].astype(str) == filial) & 
-           (df['Conta'] == conta)
-       )
-       imposto_atual = df[mask_imposto]['Valor'].where(
-           df[mask_imposto]['D/C'] == 'D',
-           -df[mask_imposto]['Valor']
-       ).sum()
-       df = df[~mask_imposto]
-       
-       # Criar lançamento do novo imposto
-       if info['valor'] > 0:
-           novos_lancamentos.append({
-               'Conta': conta,
-               'Valor': info['valor'],
-               'D/C': 'D',
-               'Hist Lanc': f'(Recálculo dos impostos) Recálculo do {info["nome"]}',
-               'Data Lcto': data_mais_recente,
-               'Centro de custo': '999999',
-               'Cod filial': filial,
-               'Obs': 'Lançamento automático'
-           })
-       
-       # Transferir diferença para 107TR
-       diferenca = imposto_atual - info['valor']
-       if diferenca != 0:
-           novos_lancamentos.append({
-               'Conta': conta,
-               'Valor': abs(diferenca),
-               'D/C': 'D' if diferenca > 0 else 'C',
-               'Hist Lanc': f'(Recálculo dos impostos) {info["nome"]} da filial {filiais[filial]}',
-               'Data Lcto': data_mais_recente,
-               'Centro de custo': '999999',
-               'Cod filial': '107TR',
-               'Obs': 'Lançamento automático'
-           })
-
-if novos_lancamentos:
-   df_novos = pd.DataFrame(novos_lancamentos)
-   df = pd.concat([df, df_novos], ignore_index=True)
+# As filiais de transferência e as contas transferidas para a 107TR estão no arquivo de regras
+# (listas 'filiais_transferencia' e 'contas_transferencia')
+
+# Impostos recalculados após a transferência: conta -> nome
+impostos_recalculo = {
+    '4101010202': 'Pis',
+    '4101010203': 'Cofins',
+    '4101010204': 'ISS'
+}
+
+# Recalcula os impostos de todas as filiais de transferência de uma vez, a partir do índice de saldos.
+# Retorna os novos lançamentos de impostos e as diferenças transferidas para a 107TR
+def recalcular_impostos(indice, filiais_recalculo, data_lancamento):
+    # Saldo original das contas 3 (créditos positivos) e valor que será transferido, por filial
+    saldo_original = -indice.saldos_por_filial(filiais_recalculo, prefixos=['3'])
+    valor_transferir = -indice.saldos_por_filial(filiais_recalculo, contas=lista_regras('contas_transferencia'))
+    saldo_remanescente = saldo_original - valor_transferir
+    
+    # Uma linha por filial e imposto
+    impostos = pd.DataFrame(
+        [(filial, conta, nome) for filial in filiais_recalculo for conta, nome in impostos_recalculo.items()],
+        columns=['Cod filial', 'Conta', 'Nome']
+    )
+    aliquotas = {'Pis': aliquota_pis, 'Cofins': aliquota_cofins}
+    impostos['Aliquota'] = [
+        aliquota_iss[filial] if nome == 'ISS' else aliquotas[nome]
+        for filial, nome in zip(impostos['Cod filial'], impostos['Nome'])
+    ]
+    
+    # Calcular novos impostos e o imposto atual (débitos positivos) de cada filial
+    impostos['Novo'] = arredondar_centavos((impostos['Cod filial'].map(saldo_remanescente) * impostos['Aliquota']).abs())
+    # (os pares filial x conta do índice seguem a mesma ordem das linhas de impostos)
+    impostos['Atual'] = indice.saldos_por_filial_conta(filiais_recalculo, list(impostos_recalculo)).to_numpy()
+    impostos['Diferenca'] = impostos['Atual'] - impostos['Novo']
+    
+    # Lançamento do novo imposto na filial
+    recalculados = impostos[impostos['Novo'] > 0]
+    novos = pd.DataFrame({
+        'Conta': recalculados['Conta'],
+        'Valor': recalculados['Novo'],
+        'D/C': 'D',
+        'Hist Lanc': '(Recálculo dos impostos) Recálculo do ' + recalculados['Nome'],
+        'Data Lcto': data_lancamento,
+        'Centro de custo': '999999',
+        'Cod filial': recalculados['Cod filial'],
+        'Obs': 'Lançamento automático'
+    })
+    
+    # Transferir diferença para 107TR
+    diferencas = impostos[impostos['Diferenca'] != 0]
+    transferidos = pd.DataFrame({
+        'Conta': diferencas['Conta'],
+        'Valor': diferencas['Diferenca'].abs(),
+        'D/C': np.where(diferencas['Diferenca'] > 0, 'D', 'C'),
+        'Hist Lanc': '(Recálculo dos impostos) ' + diferencas['Nome'] + ' da filial ' + diferencas['Cod filial'].map(filiais),
+        'Data Lcto': data_lancamento,
+        'Centro de custo': '999999',
+        'Cod filial': '107TR',
+        'Obs': 'Lançamento automático'
+    })
+    
+    return pd.concat([novos, transferidos], ignore_index=True)
+
+# Remove os lançamentos antigos dos impostos recalculados das filiais de transferência
+def remover_impostos_recalculados(df, filiais_transferencia, indice):
+    mask_imposto = (df['Cod filial'].isin(filiais_transferencia)) & (df['Conta'].isin(list(impostos_recalculo)))
+    indice.remover(df[mask_imposto])
+    return filtrar_linhas(df, ~mask_imposto)
+
+# Transfere as receitas e custos para a 107TR, substituindo os impostos das filiais pelos recalculados
+def transferir_para_107tr(razao, indice, data_lancamento):
+    filiais_transferencia = lista_regras('filiais_transferencia')
+    
+    # Migrar os lançamentos das contas 52 e das contas de ICMS e Crédito pró-cargas para a filial 107TR
+    razao.aplicar(partial(aplicar_regras, fase='transferencia', indice=indice))
+    
+    # Calcular impostos antes da transferência das contas
+    df_impostos = recalcular_impostos(indice, filiais_transferencia, data_lancamento)
+    
+    # Transferir contas para 107TR
+    razao.aplicar(partial(aplicar_regras, fase='transferencia_receitas', indice=indice))
+    
+    # Remover, de uma só vez, os lançamentos antigos dos impostos recalculados
+    razao.aplicar(partial(remover_impostos_recalculados, filiais_transferencia=filiais_transferencia, indice=indice))
+    
+    razao.acrescentar(df_impostos, indice)
+    return razao
 
 # %% [markdown]
 # ## Gerar os lançamentos de zeramento da base
 
 # %%
-# Definir as contas específicas que devem ser mantidas mesmo começando com 1 ou 2
-contas_excecao = ['2303010996', '2303010997', '2303010998', '2303010999']
-
-# Manter todas as contas que NÃO começam com 1 ou 2 OU estão na lista de exceções
-df = df[
-    (~df['Conta'].str.startswith(('1', '2'))) |  # Não começa com 1 ou 2
-    (df['Conta'].isin(contas_excecao))           # OU está na lista de exceções
-]
-
-## Gerar os lançamentos de zeramento
-def create_zeramento_df(df_input):
-    filial_df = df_input.copy()
-    # Converte todos os códigos de filial para string
-    filial_df['Cod filial'] = filial_df['Cod filial'].astype(str)
-    
-    saldos = filial_df.groupby('Cod filial').apply(
-        lambda x: x[x['D/C'] == 'D']['Valor'].sum() - x[x['D/C'] == 'C']['Valor'].sum()
-    ).reset_index()
-    saldos.columns = ['Cod filial', 'Saldo']
-    
-    zeramentos = []
-    for _, row in saldos.iterrows():
-        if row['Saldo'] != 0:
-            zeramentos.append({
-                'Conta': '2303010999',
-                'Valor': abs(row['Saldo']),
-                'D/C': 'C' if row['Saldo'] > 0 else 'D',
-                'Hist Lanc': 'Zeramento resultado contra passivo',
-                'Data Lcto': data_mais_recente,
-                'Centro de custo': '999999',
-                'Cod filial': row['Cod filial'],
-                'Obs': 'Lançamento automático'
-            })
-    
-    return pd.DataFrame(zeramentos) if zeramentos else pd.DataFrame()
+# Balancete: débitos, créditos e saldo por filial (e, opcionalmente, por classe da conta) em um único groupby
+def balancete(df_input, por_classe=False):
+    chaves = ['Cod filial', 'Classe'] if por_classe else ['Cod filial']
+    
+    valores = lambda df: pd.DataFrame({
+        'Débitos': df['Valor'].where(df['D/C'] == 'D', 0),
+        'Créditos': df['Valor'].where(df['D/C'] == 'C', 0)
+    })
+    saldos = somar_por_grupo(df_input, valores, chaves)
+    saldos['Saldo'] = saldos['Débitos'] - saldos['Créditos']
+    return saldos.reset_index()
+
+## Gerar os lançamentos de zeramento a partir do saldo de cada filial
+def create_zeramento_df(saldos, data_lancamento):
+    saldos = saldos.groupby('Cod filial', as_index=False, observed=True)['Saldo'].sum()
+    saldos = saldos[saldos['Saldo'] != 0]
+    
+    return pd.DataFrame({
+        'Conta': '2303010999',
+        'Valor': saldos['Saldo'].abs(),
+        'D/C': np.where(saldos['Saldo'] > 0, 'C', 'D'),
+        'Hist Lanc': 'Zeramento resultado contra passivo',
+        'Data Lcto': data_lancamento,
+        'Centro de custo': '999999',
+        'Cod filial': saldos['Cod filial'],
+        'Obs': 'Lançamento automático'
+    })
 
 def debug_saldos(df_input):
-    # Converte todos os códigos de filial para string antes de ordenar
-    df_temp = df_input.copy()
-    df_temp['Cod filial'] = df_temp['Cod filial'].astype(str)
-    
-    for filial in sorted(df_temp['Cod filial'].unique()):
-        filial_df = df_input[df_input['Cod filial'].astype(str) == filial]
-        debitos = filial_df[filial_df['D/C'] == 'D']['Valor'].sum()
-        creditos = filial_df[filial_df['D/C'] == 'C']['Valor'].sum()
-        saldo = debitos - creditos
-        
-        print(f"\nFilial {filial}:")
-        print(f"Total Débitos: {debitos:,.2f}")
-        print(f"Total Créditos: {creditos:,.2f}")
-        print(f"Saldo: {saldo:,.2f}")
-
-# Criar zeramentos
-zeramento_df = create_zeramento_df(df)
-
-# Concatenar somente se houver zeramentos
-if not zeramento_df.empty:
-    df = pd.concat([df, zeramento_df], ignore_index=True)
+    for _, row in balancete(df_input).iterrows():
+        print(f"\nFilial {row['Cod filial']}:")
+        print(f"Total Débitos: {para_reais(row['Débitos']):,.2f}")
+        print(f"Total Créditos: {para_reais(row['Créditos']):,.2f}")
+        print(f"Saldo: {para_reais(row['Saldo']):,.2f}")
+
+# Remove as contas patrimoniais e zera o resultado de cada filial contra o passivo.
+# Retorna o razão com os zeramentos e o balancete por filial e classe antes do zeramento
+def zerar_resultado(razao, indice, data_lancamento):
+    # Manter todas as contas que NÃO começam com 1 ou 2 OU estão na lista de exceções (fase 'zeramento' das regras)
+    razao.aplicar(partial(aplicar_regras, fase='zeramento', indice=indice))
+    
+    # Balancete por filial e classe antes do zeramento (gravado junto com o arquivo de importação)
+    balancete_df = balancete(razao, por_classe=True)
+    
+    # Criar zeramentos
+    razao.acrescentar(create_zeramento_df(balancete_df, data_lancamento), indice)
+    return razao, balancete_df
 
 # %% [markdown]
 # 
 # ## Gerar o arquivo de importação
 
 # %%
+# Limite de linhas de dados de uma planilha do Excel (1.048.576 linhas menos o cabeçalho)
+limite_linhas_excel = 1048575
+
+# Quantidade de linhas convertidas por vez ao gravar o Excel
+linhas_por_bloco_excel = 100000
+
+# Percorre as linhas do DataFrame em blocos, trocando valores vazios (NaN) por None
+def _linhas_excel(df):
+    for inicio in range(0, len(df), linhas_por_bloco_excel):
+        bloco = df.iloc[inicio:inicio + linhas_por_bloco_excel].astype(object)
+        yield from bloco.where(bloco.notna(), None).itertuples(index=False, name=None)
+
+# Grava o Excel linha a linha, sem montar a planilha inteira em memória
+def gravar_excel(df, caminho):
+    if xlsxwriter is not None:
+        workbook = xlsxwriter.Workbook(caminho, {'constant_memory': True, 'strings_to_numbers': False, 'strings_to_formulas': False, 'strings_to_urls': False})
+        worksheet = workbook.add_worksheet('Sheet1')
+        worksheet.write_row(0, 0, list(df.columns))
+        for numero, linha in enumerate(_linhas_excel(df), start=1):
+            worksheet.write_row(numero, 0, linha)
+        workbook.close()
+        return
+    
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Sheet1')
+    worksheet.append(list(df.columns))
+    for linha in _linhas_excel(df):
+        worksheet.append(linha)
+    workbook.save(caminho)
+
+# Mês (AAAAMM) de cada lançamento
+def mes_lancamento(df):
+    datas = df['Data Lcto']
+    if not pd.api.types.is_datetime64_any_dtype(datas):
+        datas = pd.to_datetime(datas, format=formato_data_protheus, errors='coerce')
+    return datas.dt.strftime('%Y%m')
+
+# Divide o DataFrame em partes que cabem no Excel: por filial ou por mês e, se ainda assim passar do limite, em partes numeradas
+def dividir_para_excel(df, divisao=divisao_saida):
+    if len(df) <= limite_linhas_excel:
+        return [('', df)]
+    
+    chave = mes_lancamento(df) if divisao == 'mes' else df['Cod filial']
+    partes = []
+    for grupo, df_grupo in df.groupby(chave, sort=True):
+        for inicio in range(0, len(df_grupo), limite_linhas_excel):
+            sufixo = f'_{grupo}' if len(df_grupo) <= limite_linhas_excel else f'_{grupo}_parte{inicio // limite_linhas_excel + 1}'
+            partes.append((sufixo, df_grupo.iloc[inicio:inicio + limite_linhas_excel]))
+    return partes
+
+# Grava o arquivo de importação nos formatos configurados e retorna os caminhos gravados
+def gravar_importacao(df, pasta, nome_base, formatos=formatos_saida, divisao=divisao_saida):
+    caminhos = []
+    for formato in formatos:
+        if formato == 'xlsx':
+            for sufixo, parte in dividir_para_excel(df, divisao):
+                caminho = os.path.join(pasta, f'{nome_base}{sufixo}.xlsx')
+                gravar_atomico(caminho, partial(gravar_excel, parte))
+                caminhos.append(caminho)
+        elif formato == 'csv':
+            caminho = os.path.join(pasta, f'{nome_base}.csv')
+            gravar_atomico(caminho, lambda temporario: df.to_csv(temporario, index=False, sep=';', decimal=',', encoding='utf-8-sig'))
+            caminhos.append(caminho)
+        elif formato == 'parquet':
+            caminho = os.path.join(pasta, f'{nome_base}.parquet')
+            gravar_atomico(caminho, lambda temporario: df.to_parquet(temporario, index=False))
+            caminhos.append(caminho)
+        else:
+            raise ValueError(f"Formato de saída desconhecido: {formato}")
+    return caminhos
 
-# Adicionar lógica para Centro de custo padrão para contas do grupo 3, 4, 7, 8 e 9 e valores vazios/NaN
-#df.loc[(df['Conta'].astype(str).str.match(r'^[34789]\d{9}$')) | 
-#       (df['Centro de custo'].isna()) | 
-#       (df['Centro de custo'] == ''), 'Centro de custo'] = '999999'
-
-# Adicionar lógica para Centro de Custo padrão para contas do grupo 3, 4, 7, 8 e 9, valores vazios/NaN, e contas específicas
-df.loc[
-    (df['Conta'].astype(str).str.match(r'^[34789]\d{9}$')) | 
-    (df['Centro de custo'].isna()) | 
-    (df['Centro de custo'] == '') | 
-    (df['Conta'].isin(['2303010996', '2303010998', '5101010112', '5201010115', '6101010231'])),
-    'Centro de custo'
-] = '999999'
-
-# DE-PARA das contas da ADM (Patrimonial)
-de_para_contas = {
-    '6101010110': '6101010231',
-    '6101010101': '6101010213',
-    '6101010201': '6101010301',
-    '6101010103': '6101010237'
-}
 
-# Aplicar DE-PARA somente quando a Filial for "ADM"
-df.loc[df['Cod filial'] == "ADM", 'Conta'] = df['Conta'].replace(de_para_contas)
+# Define a ordem das colunas e quais permanecem
+columns_to_keep = ['Conta', 'Nome da conta', 'Valor', 'D/C', 'Hist Lanc', 'Data Lcto', 'Centro de custo', 'Filial', 'Obs', 'Cod filial']
 
-# Ajustar DE-PARA das contas da ADM
-#df['Conta'] = df['Conta'].replace('6101010110', '6101010231')
-#df['Conta'] = df['Conta'].replace('6101010101', '6101010213')
-#df['Conta'] = df['Conta'].replace('6101010201', '6101010301')
+# Tipos das colunas do arquivo de importação: valores em reais e os demais campos em texto
+tipos_importacao = {coluna: 'float64' if coluna == 'Valor' else object for coluna in columns_to_keep}
 
-# Ler plano de contas pulando 3 primeiras linhas
-plano_contas = pd.read_excel(plano_filename, sheet_name='CONTAS_CONTABEIS', skiprows=3)
-plano_contas['Código da conta'] = plano_contas['Código da conta'].astype(str)
+# Fuso horário usado no nome das pastas e dos arquivos gerados
+sao_paulo_tz = pytz.timezone('America/Sao_Paulo')
+
+# Como cada coluna do arquivo de importação é obtida de uma parte do razão: nomes de contas e filiais, datas no
+# formato do Protheus e valores em reais
+def colunas_importacao(conta_dict):
+    return {
+        # Contas e filiais voltam a ser texto no arquivo de importação
+        'Conta': lambda df: df['Conta'].astype(str),
+        'Nome da conta': lambda df: df['Conta'].map(conta_dict),
+        'Valor': lambda df: para_reais(df['Valor']),
+        'D/C': lambda df: df['D/C'],
+        'Hist Lanc': lambda df: df['Hist Lanc'],
+        'Data Lcto': lambda df: converter_por_valor(df['Data Lcto'], lambda datas: datas.strftime(formato_data_protheus)),
+        'Centro de custo': lambda df: df['Centro de custo'],
+        # Preenche o nome da filial na coluna 'Filial' a partir do código da filial
+        'Filial': lambda df: df['Cod filial'].map(filiais),
+        'Obs': lambda df: df['Obs'],
+        'Cod filial': lambda df: df['Cod filial'].astype(str)
+    }
+
+# Aplica os centros de custo padrão, o DE-PARA da ADM e os nomes de contas e filiais do Accountfy e monta o arquivo
+# de importação (única concatenação das partes do razão)
+def preparar_importacao(razao, plano_contas):
+    # Centro de custo padrão (contas dos grupos 3, 4, 7, 8 e 9, valores vazios e contas específicas) e DE-PARA das
+    # contas da ADM (fase 'importacao' das regras)
+    razao = razao if isinstance(razao, RazaoLancamentos) else RazaoLancamentos([razao])
+    razao.aplicar(partial(aplicar_regras, fase='importacao'))
+    
+    # Criar coluna "Nome da conta" e fazer o cruzamento com o plano de contas
+    conta_dict = dict(zip(plano_contas['Código da conta'], plano_contas['Nome da conta']))
+    
+    return razao.materializar(colunas_importacao(conta_dict), tipos_importacao)
+
+# Grava o arquivo de importação e o balancete em Output/AAAAMM/<execução> e retorna a pasta criada
+def gravar_resultado(df, balancete_df, month_year, current_datetime):
+    # Criar estrutura de pastas
+    month_dir = os.path.join(base_dir, month_year)
+    date_dir = os.path.join(month_dir, current_datetime)
+    os.makedirs(date_dir, exist_ok=True)
+    
+    # Salvar arquivo de output (e a cópia em parquet usada na comparação entre execuções)
+    formatos = formatos_saida
+    if gravar_copia_comparacao and pa is not None and 'parquet' not in formatos:
+        formatos = formatos + ['parquet']
+    gravar_importacao(df, date_dir, f'{current_datetime}_importacao_accountfy', formatos)
+    
+    # Salvar o balancete por filial e classe, antes do zeramento
+    balancete_df = balancete_df.assign(**{coluna: para_reais(balancete_df[coluna]) for coluna in ['Débitos', 'Créditos', 'Saldo']})
+    balancete_df.to_csv(os.path.join(date_dir, f'{current_datetime}_balancete.csv'), index=False, sep=';', decimal=',', float_format='%.2f', encoding='utf-8-sig')
+    
+    return date_dir
 
-# Criar coluna "Nome da conta" e fazer o cruzamento com o plano de contas
-conta_dict = dict(zip(plano_contas['Código da conta'], plano_contas['Nome da conta']))
+# %% [markdown]
+# ## Validação
+# 
+# Depois de cada etapa, verificações vetorizadas conferem as partidas: débitos e créditos dos ajustes gerenciais,
+# total rateado de cada pool igual ao saldo do pool x soma dos percentuais, saldo de cada conta mantido na
+# transferência para a 107TR e no recálculo dos impostos, resultado zerado em cada filial após o zeramento e contas e
+# filiais do arquivo de importação cadastradas no plano de contas e em filiais. As falhas seguem a politica_validacao,
+# sem interromper a execução com perguntas no console. No modo em lote e fora da memória, cada mês é validado e
+# gravado no seu próprio processo: com 'erro', o mês que falha não é gravado, mas os meses concluídos antes dele são.
 
-# Preenche o nome da filial na coluna 'Filial' a partir do código da filial
-df['Filial'] = df['Cod filial'].astype(str).map(filiais)
+# %%
+politicas_validacao = ['aviso', 'relatorio', 'erro']
+
+class Validacao:
+    def __init__(self, politica=politica_validacao):
+        if politica not in politicas_validacao:
+            raise ValueError(f"Política de validação inválida: {politica} (use {', '.join(politicas_validacao)})")
+        self.politica = politica
+        self.falhas = []
+    
+    # Registra o resultado de uma verificação: DataFrame com uma linha por falha (vazio = verificação atendida)
+    def verificar(self, etapa, verificacao, falhas):
+        if falhas.empty:
+            return
+        
+        resumo = f"{etapa}: {verificacao} ({len(falhas)} ocorrência(s))"
+        if self.politica == 'erro':
+            raise ValueError(f"Validação: {resumo}\n{falhas.head(10).to_string(index=False)}")
+        
+        print(f"Aviso: {resumo}")
+        self.falhas.append(falhas.assign(**{'Etapa': etapa, 'Verificação': verificacao}))
+    
+    # Grava o relatório das falhas na pasta da execução (política 'relatorio')
+    def gravar(self, pasta, nome_base):
+        if self.politica != 'relatorio' or not self.falhas:
+            return
+        
+        relatorio = pd.concat(self.falhas, ignore_index=True).convert_dtypes()
+        colunas = ['Etapa', 'Verificação'] + [coluna for coluna in relatorio.columns if coluna not in ('Etapa', 'Verificação')]
+        relatorio[colunas].to_csv(os.path.join(pasta, f'{nome_base}_validacao.csv'), index=False, sep=';', decimal=',', float_format='%.2f', encoding='utf-8-sig')
+
+# Valor com sinal, já calculado no razão a partir do índice de saldos
+def _valores_assinados(df):
+    return df['Valor assinado'] if 'Valor assinado' in df else valor_assinado(df)
+
+# Diferença entre débitos e créditos de cada grupo (ou do total, sem chaves), somente onde há diferença, em reais
+def diferencas_partidas(df, chaves=()):
+    if chaves:
+        saldos = somar_por_grupo(df, _valores_assinados, chaves)
+    else:
+        saldos = pd.Series([sum(_valores_assinados(parte).sum() for parte in partes_razao(df))], dtype='int64')
+    
+    saldos = saldos[saldos != 0]
+    return para_reais(saldos).rename('Diferença').to_frame().reset_index(drop=not chaves)
+
+# Diferença entre o total rateado de cada pool (lançamentos nas filiais de destino, sem a contrapartida) e o saldo do pool
+# na filial de origem, no índice de saldos, x a soma dos percentuais das filiais de destino no mês. Somente os pools com
+# diferença, em reais
+def diferencas_rateio(df_rateio, indice, parametros, regra, data_lancamento):
+    percentuais = percentuais_rateio(parametros, regra, pd.to_datetime(data_lancamento))
+    total_percentuais = percentuais[~parametros['Cod filial'].isin(['TOTAL', regra['filial_origem']])].sum()
+    
+    contas = [pool['conta'] for pool in regra['pools']]
+    saldos = np.array([saldo_pool(indice, regra['filial_origem'], pool) for pool in regra['pools']], dtype='int64')
+    esperado = pd.Series(np.sign(saldos) * arredondar_centavos(np.abs(saldos) * total_percentuais), index=contas)
+    
+    destino = df_rateio[df_rateio['Cod filial'] != regra['filial_contrapartida']]
+    rateado = valor_assinado(destino).groupby(destino['Conta']).sum().reindex(contas, fill_value=0)
+    
+    comparacao = pd.DataFrame({'Conta': contas, 'Saldo do pool': saldos, 'Esperado': esperado, 'Rateado': rateado})
+    comparacao = comparacao[comparacao['Esperado'] != comparacao['Rateado']]
+    comparacao['Diferença'] = comparacao['Rateado'] - comparacao['Esperado']
+    return comparacao.assign(**{coluna: para_reais(comparacao[coluna]) for coluna in ['Saldo do pool', 'Esperado', 'Rateado', 'Diferença']}).reset_index(drop=True)
+
+# Saldo (débitos positivos) de cada conta do razão
+def saldos_por_conta(df):
+    saldos = somar_por_grupo(df, _valores_assinados, ['Conta'])
+    saldos.index = saldos.index.astype(str)
+    return saldos
+
+# Contas cujo saldo mudou entre os dois momentos, com a diferença em reais
+def diferencas_saldos(antes, depois):
+    diferencas = depois.sub(antes, fill_value=0)
+    diferencas = diferencas[diferencas != 0]
+    return para_reais(diferencas).rename('Diferença').rename_axis('Conta').to_frame().reset_index()
+
+# Códigos sem nome cadastrado (nome vazio no arquivo de importação), com a quantidade de lançamentos
+def codigos_sem_cadastro(df, coluna_codigo, coluna_nome):
+    return df.loc[df[coluna_nome].isna(), coluna_codigo].value_counts().rename('Linhas').rename_axis(coluna_codigo).reset_index()
 
-df['Nome da conta'] = df['Conta'].map(conta_dict)
+# %% [markdown]
+# ## Arquivo das entradas
+# 
+# Os arquivos de entrada de cada execução são guardados compactados em Output/Arquivo, uma única vez por conteúdo
+# (identificados pelo hash): os reprocessamentos com os mesmos arquivos não ocupam mais espaço. A pasta da execução
+# recebe somente o manifesto (AAAAMMDD_HHhMM_entradas.json) com o nome, o tamanho e o hash de cada arquivo.
+# O arquivamento começa em segundo plano logo após a leitura das entradas, durante o processamento e a gravação do Excel,
+# e os arquivos de origem só são removidos da pasta ao final de uma execução concluída.
+# Para recuperar os arquivos de uma execução: python accountfy.py --restaurar Output/AAAAMM/AAAAMMDD_HHhMM
 
-# Define a ordem das colunas e quais permanecem
-columns_to_keep = ['Conta', 'Nome da conta', 'Valor', 'D/C', 'Hist Lanc', 'Data Lcto', 'Centro de custo', 'Filial', 'Obs', 'Cod filial']
-df = df[columns_to_keep]
+# %%
+arquivo_dir = os.path.join(base_dir, 'Arquivo')
+
+# Arquivos de origem (removidos da pasta após o processamento) e arquivos de parâmetros (mantidos na pasta)
+def arquivos_entrada_execucao():
+    origem = [empresa['ct2'] for empresa in empresas.values()] + [sc7_filename]
+    parametros = [
+       parametros_rateio_corporativo_filename,
+       parametros_rateio_patrimonial_filename,
+       sa2_filename,
+       ajustes_gerenciais_filename,
+       caminho_regras()
+    ]
+    return origem, parametros
+
+def caminho_arquivado(hash_conteudo):
+    return os.path.join(arquivo_dir, hash_conteudo[:2], f'{hash_conteudo}.gz')
+
+# Guarda o arquivo compactado, se o mesmo conteúdo ainda não estiver no arquivo, e retorna a sua entrada no manifesto
+def arquivar_arquivo(filename):
+    hash_conteudo = hash_arquivo(filename)
+    caminho = caminho_arquivado(hash_conteudo)
+    
+    if not os.path.exists(caminho):
+        def compactar(temporario):
+            with open(filename, 'rb') as origem, gzip.open(temporario, 'wb') as destino:
+                shutil.copyfileobj(origem, destino, 1024 * 1024)
+        
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        gravar_atomico(caminho, compactar)
+    
+    return {'arquivo': os.path.basename(filename), 'tamanho': os.path.getsize(filename), 'sha256': hash_conteudo}
+
+# Arquivamento das entradas de uma execução, em threads (o hash e a compactação liberam o GIL)
+class ArquivamentoEntradas:
+    def __init__(self):
+        self.origem, parametros = arquivos_entrada_execucao()
+        self.arquivos = [filename for filename in self.origem + parametros if os.path.exists(filename)]
+        self.executor = ThreadPoolExecutor(max_workers=max(min(len(self.arquivos), os.cpu_count() or 1), 1))
+        self.futuros = [self.executor.submit(arquivar_arquivo, filename) for filename in self.arquivos]
+    
+    # Aguarda o arquivamento, grava o manifesto na pasta de cada execução e remove os arquivos de origem.
+    # Um arquivo de origem substituído durante o processamento fica na pasta
+    def concluir(self, pastas):
+        try:
+            arquivados = [futuro.result() for futuro in self.futuros]
+        finally:
+            self.executor.shutdown()
+        
+        for filename, entrada in zip(self.arquivos, arquivados):
+            entrada['origem'] = filename in self.origem
+        
+        for date_dir in pastas:
+            nome_base = os.path.basename(date_dir)
+            with open(os.path.join(date_dir, f'{nome_base}_entradas.json'), 'w', encoding='utf-8') as f:
+                json.dump({'execucao': nome_base, 'arquivos': arquivados}, f, ensure_ascii=False, indent=2)
+        
+        for filename, entrada in zip(self.arquivos, arquivados):
+            if not entrada['origem']:
+                continue
+            if hash_arquivo(filename) == entrada['sha256']:
+                os.remove(filename)
+            else:
+                print(f"Aviso: {filename} foi alterado durante o processamento e foi mantido na pasta")
+    
+    # Execução interrompida: cancela o que ainda não começou e mantém os arquivos de origem na pasta
+    def cancelar(self):
+        self.executor.shutdown(cancel_futures=True)
+
+# Recupera os arquivos de entrada de uma execução a partir do seu manifesto (por padrão, na própria pasta da execução)
+def restaurar_entradas(date_dir, destino=None):
+    destino = destino or date_dir
+    nome_base = os.path.basename(os.path.normpath(date_dir))
+    with open(os.path.join(date_dir, f'{nome_base}_entradas.json'), encoding='utf-8') as f:
+        manifesto = json.load(f)
+    
+    os.makedirs(destino, exist_ok=True)
+    for entrada in manifesto['arquivos']:
+        def descompactar(temporario):
+            with gzip.open(caminho_arquivado(entrada['sha256'])) as origem, open(temporario, 'wb') as arquivo:
+                shutil.copyfileobj(origem, arquivo, 1024 * 1024)
+        
+        gravar_atomico(os.path.join(destino, entrada['arquivo']), descompactar)
+    
+    print(f"{len(manifesto['arquivos'])} arquivo(s) da execução {nome_base} restaurado(s) em {destino}")
 
-# Gerar nome do arquivo com data atual
-sao_paulo_tz = pytz.timezone('America/Sao_Paulo')
-current_datetime = datetime.now(sao_paulo_tz).strftime('%Y%m%d_%Hh%M')
+# %% [markdown]
+# ## Comparação entre execuções
+# 
+# Nos reprocessamentos do fechamento, `python accountfy.py --comparar` mostra o que mudou no arquivo de importação em
+# relação à execução anterior do mesmo mês, a partir das cópias em parquet (sem abrir o Excel): saldos por filial x
+# conta x D/C incluídos, removidos e alterados, e os lançamentos que só existem em uma das execuções. Sem pastas, compara
+# a última execução do mês mais recente com a anterior; com uma pasta, compara essa execução com a anterior do mesmo mês;
+# com duas, compara a primeira (anterior) com a segunda. O detalhe é gravado na pasta da execução mais recente.
 
-# Extrair mês e ano do dataframe
-data_ref = pd.to_datetime(df['Data Lcto'].max())
-month_year = data_ref.strftime('%Y%m')
+# %%
+chaves_comparacao = ['Cod filial', 'Conta', 'D/C']
+
+def arquivo_comparacao(date_dir):
+    nome_base = os.path.basename(os.path.normpath(date_dir))
+    return os.path.join(date_dir, f'{nome_base}_importacao_accountfy.parquet')
+
+# Execuções do mês com a cópia em parquet, da mais antiga para a mais recente
+def execucoes_mes(month_dir):
+    pastas = [os.path.join(month_dir, nome) for nome in sorted(os.listdir(month_dir))]
+    return [pasta for pasta in pastas if os.path.exists(arquivo_comparacao(pasta))]
+
+# Execuções comparadas (anterior, atual) a partir das pastas informadas
+def execucoes_comparadas(pastas):
+    if len(pastas) > 2:
+        raise ValueError("Informe no máximo duas pastas de execução para comparar")
+    if len(pastas) == 2:
+        return [os.path.normpath(pasta) for pasta in pastas]
+    
+    if pastas:
+        atual = os.path.normpath(pastas[0])
+        month_dir = os.path.dirname(atual)
+    else:
+        meses = sorted(nome for nome in os.listdir(base_dir) if nome.isdigit()) if os.path.isdir(base_dir) else []
+        if not meses:
+            raise FileNotFoundError(f"Nenhuma execução encontrada em {base_dir}")
+        month_dir = os.path.join(base_dir, meses[-1])
+        atual = execucoes_mes(month_dir)[-1] if execucoes_mes(month_dir) else month_dir
+    
+    anteriores = [pasta for pasta in execucoes_mes(month_dir) if os.path.basename(pasta) < os.path.basename(atual)]
+    if not anteriores:
+        raise FileNotFoundError(f"Nenhuma execução anterior a {atual} com a cópia em parquet do arquivo de importação")
+    return [anteriores[-1], atual]
+
+# Saldo (em centavos) e quantidade de lançamentos por filial x conta x D/C, agrupados pelo hash das chaves
+def saldos_comparacao(df):
+    chave = pd.util.hash_pandas_object(df[chaves_comparacao], index=False).to_numpy()
+    saldos = pd.Series(np.asarray(arredondar_centavos(df['Valor'] * 100)), index=chave).groupby(level=0).agg(['sum', 'size'])
+    saldos.columns = ['Valor', 'Lançamentos']
+    
+    rotulos = df[chaves_comparacao].set_axis(chave)
+    return saldos.join(rotulos[~rotulos.index.duplicated()])
+
+# Saldos incluídos, removidos e alterados entre as duas execuções, do maior para o menor valor de diferença
+def comparar_saldos(df_anterior, df_atual):
+    anterior, atual = saldos_comparacao(df_anterior), saldos_comparacao(df_atual)
+    comparacao = anterior[['Valor', 'Lançamentos']].join(atual[['Valor', 'Lançamentos']], how='outer', lsuffix=' anterior', rsuffix=' atual')
+    rotulos = atual[chaves_comparacao].combine_first(anterior[chaves_comparacao])
+    
+    comparacao['Situação'] = np.select(
+        [comparacao['Valor anterior'].isna(), comparacao['Valor atual'].isna()],
+        ['Incluído', 'Removido'],
+        np.where(
+            (comparacao['Valor anterior'] != comparacao['Valor atual']) | (comparacao['Lançamentos anterior'] != comparacao['Lançamentos atual']),
+            'Alterado', ''
+        )
+    )
+    comparacao = comparacao[comparacao['Situação'] != ''].join(rotulos)
+    comparacao = comparacao.fillna({coluna: 0 for coluna in ['Valor anterior', 'Valor atual', 'Lançamentos anterior', 'Lançamentos atual']})
+    comparacao['Diferença'] = comparacao['Valor atual'] - comparacao['Valor anterior']
+    comparacao = comparacao.sort_values('Diferença', key=np.abs, ascending=False, kind='stable')
+    
+    for coluna in ['Valor anterior', 'Valor atual', 'Diferença']:
+        comparacao[coluna] = para_reais(comparacao[coluna])
+    colunas = ['Situação'] + chaves_comparacao + ['Valor anterior', 'Valor atual', 'Diferença', 'Lançamentos anterior', 'Lançamentos atual']
+    return comparacao[colunas].astype({'Lançamentos anterior': 'int64', 'Lançamentos atual': 'int64'}).reset_index(drop=True)
+
+# Identificação de cada lançamento: hash de todas as colunas + ordem de ocorrência dos lançamentos repetidos
+def _identificacao_lancamentos(df):
+    conteudo = pd.util.hash_pandas_object(df, index=False)
+    ocorrencia = conteudo.groupby(conteudo).cumcount()
+    return pd.util.hash_pandas_object(pd.DataFrame({'conteudo': conteudo, 'ocorrencia': ocorrencia}), index=False)
+
+# Lançamentos que só existem em uma das execuções
+def comparar_lancamentos(df_anterior, df_atual):
+    anterior, atual = _identificacao_lancamentos(df_anterior), _identificacao_lancamentos(df_atual)
+    return pd.concat([
+        df_atual[~atual.isin(anterior)].assign(**{'Situação': 'Incluído'}),
+        df_anterior[~anterior.isin(atual)].assign(**{'Situação': 'Removido'})
+    ], ignore_index=True)
+
+# Compara duas execuções, mostra o resumo e grava o detalhe na pasta da execução mais recente
+def comparar_execucoes(pastas=()):
+    pasta_anterior, pasta_atual = execucoes_comparadas(list(pastas))
+    df_anterior, df_atual = (pd.read_parquet(arquivo_comparacao(pasta)) for pasta in [pasta_anterior, pasta_atual])
+    
+    saldos = comparar_saldos(df_anterior, df_atual)
+    lancamentos = comparar_lancamentos(df_anterior, df_atual)
+    
+    nome_anterior, nome_atual = os.path.basename(pasta_anterior), os.path.basename(pasta_atual)
+    nome_base = os.path.join(pasta_atual, f'{nome_atual}_comparacao_{nome_anterior}')
+    saldos.to_csv(f'{nome_base}.csv', index=False, sep=';', decimal=',', float_format='%.2f', encoding='utf-8-sig')
+    lancamentos[['Situação'] + columns_to_keep].to_csv(f'{nome_base}_lancamentos.csv', index=False, sep=';', decimal=',', float_format='%.2f', encoding='utf-8-sig')
+    
+    situacoes = lambda df: ', '.join(f"{quantidade} {situacao.lower()}(s)" for situacao, quantidade in df['Situação'].value_counts().items()) or 'nenhuma diferença'
+    print(f"Comparação de {pasta_atual} com a execução anterior {pasta_anterior}:")
+    print(f"  Saldos (filial x conta x D/C): {situacoes(saldos)}")
+    print(f"  Lançamentos: {situacoes(lancamentos)}")
+    if not saldos.empty:
+        print(saldos.head(20).to_string(index=False))
+    print(f"Detalhes em {nome_base}.csv e {nome_base}_lancamentos.csv")
+    return saldos, lancamentos
 
-# Criar estrutura de pastas
-base_dir = 'Output'
-month_dir = os.path.join(base_dir, month_year)
-date_dir = os.path.join(month_dir, current_datetime)
+# %% [markdown]
+# ## Processamento dos períodos
+# 
+# Cada período (mês) passa pelos ajustes, rateios, transferência para a 107TR, recálculo dos impostos e zeramento
+# com o seu próprio índice de saldos. No modo em lote, os meses dos arquivos de entrada são processados em paralelo,
+# em processos separados, e cada mês gera o seu arquivo de importação em Output/AAAAMM.
 
-# Criar diretórios
-for dir_path in [base_dir, month_dir, date_dir]:
-   if not os.path.exists(dir_path):
-       os.makedirs(dir_path)
+# %%
+# Processa os lançamentos de um período (DataFrame ou razão em partes) e retorna o arquivo de importação e o balancete antes do zeramento.
+# Os ajustes gerenciais só são lançados quando incluir_ajustes for verdadeiro
+def processar_periodo(razao, parametros, incluir_ajustes=True, perfil=None, validacao=None):
+    perfil = perfil or PerfilExecucao(ativo=False)
+    validacao = validacao or Validacao()
+    razao = razao if isinstance(razao, RazaoLancamentos) else RazaoLancamentos([razao])
+    
+    # Data mais recente
+    data_mais_recente = pd.Series([parte['Data Lcto'].max() for parte in razao.partes]).max()
+    
+    with perfil.etapa('Ajustes gerenciais', razao) as medicao:
+        # Ajustes gerenciais (opcional), como uma parte separada do razão
+        ajustes = parametros['ajustes']
+        if incluir_ajustes and ajustes is not None and not ajustes.empty:
+            validacao.verificar('Ajustes gerenciais', 'Diferença entre débitos e créditos dos ajustes', diferencas_partidas(ajustes))
+            razao = RazaoLancamentos(razao.partes + [gerar_ajustes_gerenciais(ajustes, data_mais_recente)])
+        
+        medicao['saida'] = ajustar_filiais(razao)
+    
+    with perfil.etapa('Índice de saldos', razao) as medicao:
+        # Valor com sinal e índice de saldos do razão, atualizados pelas próximas etapas
+        for parte in razao.partes:
+            parte['Valor assinado'] = valor_assinado(parte)
+        indice = IndiceSaldos(razao)
+        medicao['saida'] = razao
+    
+    # Rateios da patrimonial e do corporativo
+    for regra, nome, etapa in [
+        (regra_rateio_patrimonial, 'rateio_patrimonial', 'Rateio patrimonial'),
+        (regra_rateio_corporativo, 'rateio_corporativo', 'Rateio corporativo')
+    ]:
+        with perfil.etapa(etapa, razao) as medicao:
+            df_rateio = gerar_rateio(indice, parametros[nome], regra, data_mais_recente)
+            validacao.verificar(etapa, 'Total rateado diferente do saldo do pool x percentuais', diferencas_rateio(df_rateio, indice, parametros[nome], regra, data_mais_recente))
+            razao.acrescentar(df_rateio, indice)
+            medicao['saida'] = razao
+    
+    with perfil.etapa('Transferência e recálculo dos impostos', razao) as medicao:
+        # A transferência só muda a filial dos lançamentos, e o imposto recalculado + a diferença na 107TR = imposto anterior
+        saldos_antes = saldos_por_conta(razao)
+        medicao['saida'] = transferir_para_107tr(razao, indice, data_mais_recente)
+        validacao.verificar('Transferência e recálculo dos impostos', 'Saldo da conta alterado', diferencas_saldos(saldos_antes, saldos_por_conta(razao)))
+    
+    with perfil.etapa('Zeramento', razao) as medicao:
+        razao, balancete_df = zerar_resultado(razao, indice, data_mais_recente)
+        validacao.verificar('Zeramento', 'Resultado da filial não zerado', diferencas_partidas(razao, ['Cod filial']))
+        medicao['saida'] = razao
+    
+    with perfil.etapa('Arquivo de importação', razao) as medicao:
+        df_final = medicao['saida'] = preparar_importacao(razao, parametros['plano_contas'])
+        validacao.verificar('Arquivo de importação', 'Conta fora do plano de contas', codigos_sem_cadastro(df_final, 'Conta', 'Nome da conta'))
+        validacao.verificar('Arquivo de importação', 'Filial sem nome cadastrado', codigos_sem_cadastro(df_final, 'Cod filial', 'Filial'))
+    
+    return df_final, balancete_df, data_mais_recente.strftime('%Y%m')
 
-# Salvar arquivo de output
-output_filename = f'{current_datetime}_importacao_accountfy.xlsx'
-output_path = os.path.join(date_dir, output_filename)
-df.to_excel(output_path, index=False)
+# Processa e grava um período (também executado nos processos do modo em lote)
+def processar_e_gravar_periodo(razao, parametros, current_datetime, incluir_ajustes=True, perfil=None, validacao=None):
+    perfil = perfil or PerfilExecucao(ativo=False)
+    validacao = validacao or Validacao()
+    df_final, balancete_df, month_year = processar_periodo(razao, parametros, incluir_ajustes, perfil, validacao)
+    
+    with perfil.etapa('Gravação dos arquivos', df_final):
+        date_dir = gravar_resultado(df_final, balancete_df, month_year, current_datetime)
+        validacao.gravar(date_dir, current_datetime)
+    
+    perfil.gravar(date_dir, current_datetime, execucao=current_datetime, periodo=month_year, regras=carregar_regras()['versao'])
+    return date_dir
+
+# Executa funcao(*argumentos) de cada período em processos separados (no máximo processos ao mesmo tempo; no notebook,
+# em threads). Retorna as pastas gravadas, em ordem cronológica
+def _processar_periodos(funcao, tarefas, processos):
+    if executando_no_notebook:
+        executor_periodos = ThreadPoolExecutor(max_workers=min(len(tarefas), processos))
+    else:
+        executor_periodos = ProcessPoolExecutor(max_workers=min(len(tarefas), processos), mp_context=contexto_processos())
+    with executor_periodos as executor:
+        futuros = {executor.submit(funcao, *argumentos): periodo for periodo, argumentos in tarefas.items()}
+        pastas = {}
+        for futuro in as_completed(futuros):
+            periodo = futuros[futuro]
+            try:
+                pastas[periodo] = futuro.result()
+            except Exception as erro:
+                executor.shutdown(wait=False, cancel_futures=True)
+                gravados = f" (períodos já gravados: {', '.join(str(p) for p in sorted(pastas))})" if pastas else ''
+                raise RuntimeError(f"Erro ao processar o período {periodo}{gravados}: {erro}") from erro
+            print(f"Período {periodo} gravado em {pastas[periodo]}")
+    
+    return [pastas[periodo] for periodo in sorted(pastas)]
 
-# Mover arquivos de origem
-files_to_move = [
-   ct2_filename, 
-   sc7_filename,
-   ct2_filename_dagnoni
-]
+# Divide cada parte do razão por mês de lançamento e processa os meses em paralelo. Os ajustes gerenciais só entram no
+# último mês. Retorna as pastas gravadas, em ordem cronológica
+def processar_em_lote(razao, parametros, current_datetime, perfil=None, validacao=None):
+    perfil = perfil or PerfilExecucao(ativo=False)
+    validacao = validacao or Validacao()
+    
+    partes_periodo = {}
+    sem_data = 0
+    for parte in partes_razao(razao):
+        periodos = parte['Data Lcto'].dt.to_period('M')
+        sem_data += int(periodos.isna().sum())
+        for periodo, df_periodo in parte.groupby(periodos, sort=True):
+            partes_periodo.setdefault(periodo, []).append(df_periodo)
+    if sem_data:
+        print(f"Aviso: {sem_data} lançamento(s) sem data de lançamento válida não entram no processamento em lote")
+    
+    ultimo_periodo = max(partes_periodo)
+    tarefas = {
+        periodo: (RazaoLancamentos(partes), parametros, current_datetime, periodo == ultimo_periodo, perfil.do_periodo(periodo), Validacao(validacao.politica))
+        for periodo, partes in sorted(partes_periodo.items())
+    }
+    return _processar_periodos(processar_e_gravar_periodo, tarefas, os.cpu_count() or 1)
 
-# Copiar arquivos de parâmetros
-files_to_copy = [
-   parametros_rateio_corporativo_filename,
-   parametros_rateio_patrimonial_filename,
-   sa2_filename,
-   ajustes_gerenciais_filename
-]
+# %% [markdown]
+# ### Processamento fora da memória
+# 
+# Para os reprocessamentos do ano inteiro, os lançamentos não precisam caber na memória: a CT2 é lida em lotes
+# (ct2_tamanho_lote) e cada lote, já tratado, é gravado em disco na pasta Particoes, separado pelo mês do lançamento.
+# Depois, cada mês é lido do disco e passa pelas mesmas etapas do modo em lote, em processos separados (no máximo
+# processos_fora_da_memoria ao mesmo tempo), gerando os mesmos arquivos de importação.
 
-for file in files_to_move:
-   if os.path.exists(file):
-       shutil.move(file, date_dir)
+# %%
+# Lançamentos gravados em disco por mês de lançamento (pasta/AAAA-MM/NNNNNN.parquet), na ordem em que são acrescentados
+class ParticoesRazao:
+    def __init__(self, pasta):
+        self.pasta = pasta
+        self.partes = 0
+        self.linhas = 0
+        self.sem_data = 0
+    
+    # Acrescenta os lançamentos às partições dos seus meses. Lançamentos sem data válida ficam fora, como no modo em lote
+    def acrescentar(self, df):
+        periodos = df['Data Lcto'].dt.to_period('M')
+        self.sem_data += int(periodos.isna().sum())
+        for periodo, df_periodo in df.groupby(periodos, sort=True):
+            destino = os.path.join(self.pasta, str(periodo))
+            os.makedirs(destino, exist_ok=True)
+            df_periodo.to_parquet(os.path.join(destino, f'{self.partes:06d}.parquet'), index=False)
+            self.linhas += len(df_periodo)
+        self.partes += 1
+    
+    # Pastas dos meses gravados, em ordem cronológica
+    def periodos(self):
+        return {periodo: os.path.join(self.pasta, periodo) for periodo in sorted(os.listdir(self.pasta))} if os.path.isdir(self.pasta) else {}
+
+# Lê os lançamentos de um mês, na ordem em que foram gravados: cada arquivo gravado é uma parte do razão
+def ler_particao(pasta):
+    return RazaoLancamentos([pd.read_parquet(os.path.join(pasta, parte)) for parte in sorted(os.listdir(pasta))])
+
+# Lê e processa um mês gravado em disco (executado nos processos do modo fora da memória)
+def processar_particao(pasta, parametros, current_datetime, incluir_ajustes=True, perfil=None, validacao=None):
+    perfil = perfil or PerfilExecucao(ativo=False)
+    with perfil.etapa('Leitura dos lançamentos do mês') as medicao:
+        razao = medicao['saida'] = ler_particao(pasta)
+    
+    return processar_e_gravar_periodo(razao, parametros, current_datetime, incluir_ajustes, perfil, validacao)
+
+# Grava o razão em disco por mês e processa os meses separadamente. Os ajustes gerenciais só entram no último mês.
+# Retorna as pastas gravadas, em ordem cronológica
+def processar_fora_da_memoria(entradas, parametros, current_datetime, perfil=None, validacao=None):
+    perfil = perfil or PerfilExecucao(ativo=False)
+    validacao = validacao or Validacao()
+    if pa is None:
+        raise RuntimeError("O processamento fora da memória requer o pyarrow")
+    
+    shutil.rmtree(particoes_dir, ignore_errors=True)
+    particoes = ParticoesRazao(particoes_dir)
+    try:
+        # Mesma ordem do razão montado em memória: CT2 de cada empresa e lançamentos da SC7
+        with perfil.etapa('Gravação do razão por mês') as medicao:
+            for empresa, cadastro in empresas.items():
+                for lote in ler_protheus(cadastro['ct2'], 'CT2', ct2_tamanho_lote or 250000):
+                    particoes.acrescentar(filiais_empresa(normalizar_ct2(lote), empresa))
+            particoes.acrescentar(lancamentos_sc7(entradas))
+            medicao['linhas_saida'] = particoes.linhas
+        
+        if particoes.sem_data:
+            print(f"Aviso: {particoes.sem_data} lançamento(s) sem data de lançamento válida não entram no processamento fora da memória")
+        
+        periodos = particoes.periodos()
+        ultimo_periodo = max(periodos)
+        tarefas = {
+            periodo: (pasta, parametros, current_datetime, periodo == ultimo_periodo, perfil.do_periodo(periodo), Validacao(validacao.politica))
+            for periodo, pasta in periodos.items()
+        }
+        return _processar_periodos(processar_particao, tarefas, processos_fora_da_memoria)
+    finally:
+        shutil.rmtree(particoes_dir, ignore_errors=True)
+
+# Executa o processamento completo com os arquivos da pasta atual e retorna as pastas gravadas.
+# Com memoria, os arquivos de referência são reaproveitados entre execuções (ver carregar_entradas)
+# Cada arquivo de importação recebe o seu relatório de etapas (no modo em lote, as etapas de leitura se repetem em todos os meses)
+# Fora da memória, a CT2 não é lida inteira: é lida em lotes por processar_fora_da_memoria
+def executar(lote=processamento_em_lote, memoria=None, perfil=None, fora_da_memoria=processamento_fora_da_memoria, validacao=None):
+    perfil = perfil or PerfilExecucao()
+    validacao = validacao or Validacao()
+    
+    with perfil.etapa('Leitura dos arquivos de entrada') as medicao:
+        ignorar = list(entradas_ct2) if fora_da_memoria else []
+        entradas = medicao['saida'] = carregar_entradas(memoria=memoria, ignorar=ignorar)
+    
+    # Somente os parâmetros são enviados para os processos de cada período
+    parametros = {nome: entradas[nome] for nome in ['rateio_patrimonial', 'rateio_corporativo', 'ajustes', 'plano_contas']}
+    
+    # Gerar nome do arquivo com data atual
+    current_datetime = datetime.now(sao_paulo_tz).strftime('%Y%m%d_%Hh%M')
+    
+    # Arquivar as entradas em segundo plano, durante o processamento
+    arquivamento = ArquivamentoEntradas()
+    try:
+        if fora_da_memoria:
+            pastas = processar_fora_da_memoria(entradas, parametros, current_datetime, perfil, validacao)
+        elif lote:
+            pastas = processar_em_lote(montar_razao(entradas, perfil), parametros, current_datetime, perfil, validacao)
+        else:
+            # Todos os lançamentos em um único período, na data mais recente dos arquivos
+            pastas = [processar_e_gravar_periodo(montar_razao(entradas, perfil), parametros, current_datetime, perfil=perfil, validacao=validacao)]
+    except BaseException:
+        arquivamento.cancelar()
+        raise
+    
+    arquivamento.concluir(pastas)
+    return pastas
 
-for file in files_to_copy:
-   if os.path.exists(file):
-       shutil.copy2(file, date_dir)
+# %% [markdown]
+# ## Modo serviço
+# 
+# Com `python accountfy.py --monitorar`, o processo fica aberto verificando a pasta: assim que a CT2, a CT2 da Dagnoni
+# e a SC7 são colocadas na pasta (e param de mudar de tamanho), o processamento é executado e os arquivos são arquivados
+# e removidos da pasta, como em uma execução normal. O plano de contas, a SA2 e os parâmetros de rateio ficam em memória
+# e só são lidos novamente quando o arquivo é alterado.
 
-#df.to_excel(output_filename, index=False, engine='xlsxwriter')
+# %%
+# Arquivos cuja chegada dispara o processamento no modo serviço
+arquivos_gatilho = [empresa['ct2'] for empresa in empresas.values()] + [sc7_filename]
 
+def monitorar_pasta(intervalo=intervalo_monitoramento, lote=processamento_em_lote, console=perfil_console, fora_da_memoria=processamento_fora_da_memoria, politica=politica_validacao):
+    memoria = {}
+    assinatura_anterior = assinatura_processada = minuto_processado = None
+    print(f"Aguardando os arquivos {', '.join(arquivos_gatilho)} (Ctrl+C para encerrar)...")
+    
+    try:
+        while True:
+            time.sleep(intervalo)
+            if not all(os.path.exists(filename) for filename in arquivos_gatilho):
+                assinatura_anterior = None
+                continue
+            
+            # Processar somente quando os arquivos pararem de mudar entre duas verificações (cópia concluída),
+            # e não repetir um processamento que já falhou com os mesmos arquivos
+            assinatura = [assinatura_arquivo(filename) for filename in arquivos_gatilho]
+            if assinatura != assinatura_anterior or assinatura == assinatura_processada:
+                assinatura_anterior = assinatura
+                continue
+            
+            # As pastas e arquivos gerados são nomeados pelo minuto da execução: aguardar o próximo minuto
+            if datetime.now(sao_paulo_tz).strftime('%Y%m%d_%Hh%M') == minuto_processado:
+                continue
+            
+            assinatura_processada = assinatura
+            minuto_processado = datetime.now(sao_paulo_tz).strftime('%Y%m%d_%Hh%M')
+            inicio = time.perf_counter()
+            try:
+                pastas = executar(lote, memoria, PerfilExecucao(console=console), fora_da_memoria, Validacao(politica))
+            except Exception as erro:
+                print(f"Erro no processamento: {erro}")
+                continue
+            print(f"Arquivo(s) gerado(s) em {', '.join(pastas)} ({time.perf_counter() - inicio:.1f}s)")
+    except KeyboardInterrupt:
+        print("Monitoramento encerrado.")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Converte as tabelas CT2 e SC7 do Protheus para o padrão de importação do Accountfy')
+    parser.add_argument('--lote', action='store_true', help='processar cada mês dos arquivos de entrada separadamente, com um arquivo de importação por mês')
+    parser.add_argument('--fora-da-memoria', action='store_true', help='ler a CT2 em lotes e gravar os lançamentos em disco por mês, processando cada mês separadamente (arquivos maiores que a memória)')
+    parser.add_argument('--monitorar', action='store_true', help='ficar aguardando novos arquivos na pasta e processá-los assim que chegarem')
+    parser.add_argument('--intervalo', type=float, default=intervalo_monitoramento, help='segundos entre as verificações da pasta no modo serviço')
+    parser.add_argument('--restaurar', metavar='PASTA', help='recuperar os arquivos de entrada da execução gravada na pasta informada (Output/AAAAMM/AAAAMMDD_HHhMM)')
+    parser.add_argument('--validacao', choices=politicas_validacao, default=politica_validacao, help='o que fazer quando uma verificação falha: mostrar um aviso, gravar também o relatório das falhas ou interromper o processamento')
+    parser.add_argument('--comparar', nargs='*', metavar='PASTA', help='comparar o arquivo de importação com o da execução anterior do mesmo mês (sem pastas: a última execução; com duas pastas: a anterior e a atual)')
+    parser.add_argument('--perfil', action='store_true', help='mostrar no console o tempo, a memória e as linhas de cada etapa')
+    # No notebook, valem as configurações do início do arquivo
+    args = parser.parse_args([] if argv is None and executando_no_notebook else argv)
+    
+    lote = args.lote or processamento_em_lote
+    fora_da_memoria = args.fora_da_memoria or processamento_fora_da_memoria
+    console = args.perfil or perfil_console
+    if args.restaurar:
+        restaurar_entradas(args.restaurar)
+    elif args.comparar is not None:
+        comparar_execucoes(args.comparar)
+    elif args.monitorar:
+        monitorar_pasta(args.intervalo, lote, console, fora_da_memoria, args.validacao)
+    else:
+        executar(lote, perfil=PerfilExecucao(console=console), fora_da_memoria=fora_da_memoria, validacao=Validacao(args.validacao))
 
+# A execução fica protegida para que os processos do modo em lote possam importar este arquivo
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# %% [markdown]
+# # Benchmark do importador
+#
+# Gera arquivos sintéticos nas escalas informadas (ver `gerar_dados_sinteticos.py`), executa o processamento completo
+# em um processo separado para cada escala e registra o tempo total, o pico de memória e o tempo de cada etapa
+# (relatório de etapas do `accountfy.py`) em `Benchmark/historico.csv`, junto com a versão do código (commit do git).
+# Cada execução é comparada com a execução anterior da mesma escala registrada no histórico.
+#
+# Uso: `python benchmark.py --linhas 100000 1000000 10000000`
+
+# %%
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+import pandas as pd
+
+from gerar_dados_sinteticos import gerar_dados
+
+# Pasta dos arquivos sintéticos, das execuções e do histórico
+pasta_benchmark = 'Benchmark'
+historico_filename = os.path.join(pasta_benchmark, 'historico.csv')
+
+pasta_projeto = os.path.dirname(os.path.abspath(__file__))
+
+# Versão do código medida: commit atual (com '+' quando há alterações não commitadas)
+def versao_codigo():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=pasta_projeto, capture_output=True, text=True, check=True).stdout.strip()
+        alterado = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=pasta_projeto, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'desconhecida'
+    return commit + ('+' if alterado else '')
+
+# Arquivos sintéticos da escala, gerados uma única vez e reaproveitados nas próximas execuções
+def dados_escala(linhas, meses):
+    pasta = os.path.join(pasta_benchmark, f'dados_{linhas}_{meses}m')
+    if not os.path.exists(os.path.join(pasta, 'CT2.csv')):
+        print(f"Gerando {linhas:,} linhas sintéticas...")
+        gerar_dados(pasta, linhas, meses, ultimo_mes='2026-01')
+    return pasta
+
+# Executa o accountfy.py em uma cópia dos arquivos (o processamento move as entradas para Output), com o cache vazio,
+# e retorna as medições da execução
+def executar_escala(linhas, meses, argumentos):
+    dados = dados_escala(linhas, meses)
+    pasta = os.path.join(pasta_benchmark, 'execucao')
+    shutil.rmtree(pasta, ignore_errors=True)
+    shutil.copytree(dados, pasta)
+
+    inicio = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(pasta_projeto, 'accountfy.py'), *argumentos], cwd=pasta, check=True)
+    tempo_total = time.perf_counter() - inicio
+
+    # Relatórios de etapas gravados pela execução (um por mês no modo em lote)
+    etapas = []
+    for relatorio in glob.glob(os.path.join(pasta, 'Output', '*', '*', '*_etapas.json')):
+        with open(relatorio, encoding='utf-8') as f:
+            etapas.extend(json.load(f)['etapas'])
+
+    medicoes = [{'Etapa': 'Total', 'Tempo (s)': round(tempo_total, 3)}]
+    if etapas:
+        # No modo em lote, o relatório de cada mês repete as etapas do processo principal (mesmo processo, sem período):
+        # cada etapa entra uma única vez
+        etapas = pd.DataFrame(etapas).drop_duplicates(subset=['Etapa', 'Processo', 'Período'])
+        medicoes[0]['Pico de memória (MB)'] = etapas['Pico de memória (MB)'].max()
+        # No modo em lote, os meses rodam em paralelo: soma do tempo de cada etapa em todos os processos
+        por_etapa = etapas.groupby('Etapa', sort=False).agg({'Tempo (s)': 'sum', 'Pico de memória (MB)': 'max'}).reset_index()
+        medicoes += por_etapa.to_dict('records')
+
+    shutil.rmtree(pasta, ignore_errors=True)
+    return medicoes
+
+# Acrescenta as medições ao histórico e mostra a comparação com a execução anterior da mesma escala
+def registrar(medicoes, linhas, meses, argumentos):
+    atual = pd.DataFrame(medicoes).assign(**{
+        'Data': datetime.now().strftime('%Y-%m-%d %H:%M'),
+        'Versão': versao_codigo(),
+        'Linhas': linhas,
+        'Meses': meses,
+        'Argumentos': ' '.join(argumentos)
+    })
+
+    anterior = pd.DataFrame()
+    if os.path.exists(historico_filename):
+        historico = pd.read_csv(historico_filename, sep=';', decimal=',', encoding='utf-8-sig', keep_default_na=False, na_values={'Tempo (s)': [''], 'Pico de memória (MB)': ['']})
+        mesma_escala = historico[(historico['Linhas'] == linhas) & (historico['Meses'] == meses) & (historico['Argumentos'] == ' '.join(argumentos))]
+        if not mesma_escala.empty:
+            anterior = mesma_escala[mesma_escala['Data'] == mesma_escala['Data'].iloc[-1]].set_index('Etapa')
+
+    os.makedirs(pasta_benchmark, exist_ok=True)
+    atual.to_csv(historico_filename, mode='a', header=not os.path.exists(historico_filename), index=False, sep=';', decimal=',', encoding='utf-8-sig')
+
+    resumo = atual.set_index('Etapa')[['Tempo (s)', 'Pico de memória (MB)']]
+    if not anterior.empty:
+        resumo['Tempo anterior (s)'] = anterior['Tempo (s)'].reindex(resumo.index)
+        resumo['Variação (%)'] = ((resumo['Tempo (s)'] / resumo['Tempo anterior (s)'] - 1) * 100).round(1)
+        print(f"\n{linhas:,} linhas (versão {atual['Versão'].iloc[0]}; anterior: {anterior['Versão'].iloc[0]} em {anterior['Data'].iloc[0]}):")
+    else:
+        print(f"\n{linhas:,} linhas (versão {atual['Versão'].iloc[0]}):")
+    print(resumo.to_string())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Mede o tempo e a memória do importador com arquivos sintéticos')
+    parser.add_argument('--linhas', type=int, nargs='+', default=[100000], help='escalas (linhas da CT2) a medir')
+    parser.add_argument('--meses', type=int, default=1, help='quantidade de meses dos arquivos sintéticos')
+    parser.add_argument('--repeticoes', type=int, default=1, help='execuções por escala')
+    parser.add_argument('--lote', action='store_true', help='executar o importador no modo em lote (um arquivo por mês)')
+    args = parser.parse_args(argv)
+
+    argumentos = ['--lote'] if args.lote else []
+    for linhas in args.linhas:
+        for _ in range(args.repeticoes):
+            registrar(executar_escala(linhas, args.meses, argumentos), linhas, args.meses, argumentos)
+
+if __name__ == '__main__':
+    main()
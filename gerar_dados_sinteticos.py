@@ -0,0 +1,181 @@
+# %% [markdown]
+# # Gerar arquivos sintéticos no layout das exportações do Protheus
+#
+# Gera a CT2 de cada empresa cadastrada no importador (`CT2.csv`, `CT2_Dagnoni.csv`), `SC7.csv` e `SA2.csv` no mesmo
+# formato exportado pelo Protheus (latin-1, separados por ponto e vírgula, duas linhas antes do cabeçalho e vírgula
+# decimal), junto com o plano de contas, os parâmetros de rateio e os ajustes gerenciais, para medir o desempenho do
+# importador em volumes como 100 mil, 1 milhão ou 10 milhões de linhas.
+#
+# Uso: `python gerar_dados_sinteticos.py --linhas 1000000 --pasta Sinteticos`
+
+# %%
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+# As filiais, as alíquotas e os nomes dos arquivos são os mesmos do importador
+import accountfy
+
+# Contas de resultado e patrimoniais usadas nos lançamentos sintéticos
+contas_resultado = [
+    '3101010101', '3101010104', '3101010105',
+    '4101010201', '4101010202', '4101010203', '4101010204', '4101010206',
+    '5101010101', '5101010112', '5201010101', '5201010115', '5301010101',
+    '6101010101', '6101010103', '6101010110', '6101010201', '6101010231',
+    '7101010101', '8101010101', '9101010101'
+]
+contas_patrimoniais = ['1101010101', '1102010101', '2101010101', '2201010101']
+
+# Contas que aparecem somente nos lançamentos gerados pelo importador (rateio, zeramento e DE-PARA da ADM)
+contas_automaticas = [
+    '5301010901', '5301010902', '2303010996', '2303010997', '2303010998', '2303010999',
+    '6101010213', '6101010237', '6101010301'
+]
+
+centros_custo = np.array(['10101', '010102', '20201', '030101', '40101', ''])
+historicos = np.array([
+    'PAGTO FORNECEDOR - NF 000123', 'FOLHA DE PAGAMENTO', 'PROVISAO FERIAS - MES', 'RECEITA DE SERVICOS',
+    'DEPRECIACAO DO MES', 'TARIFA BANCARIA', 'ARMAZENAGEM - CLIENTE XYZ'
+])
+rotinas = np.array(['CTBA102', 'CTBA500', 'MATA103', 'FINA050'])
+
+# Meses dos lançamentos: o último mês informado e os anteriores
+def meses_periodo(ultimo_mes, quantidade):
+    return pd.period_range(end=pd.Period(ultimo_mes, freq='M'), periods=quantidade, freq='M')
+
+# Datas aleatórias (dd/mm/aaaa) distribuídas pelos meses informados
+def datas_aleatorias(rng, meses, quantidade):
+    dias = pd.DatetimeIndex(np.concatenate([pd.date_range(mes.start_time, mes.end_time.normalize()).values for mes in meses]))
+    return np.asarray(dias.strftime(accountfy.formato_data_protheus))[rng.integers(0, len(dias), quantidade)]
+
+# Valores em reais com centavos, com muitos valores pequenos e poucos grandes
+def valores_aleatorios(rng, quantidade):
+    return np.round(rng.lognormal(mean=6, sigma=1.8, size=quantidade), 2)
+
+# Grava o CSV como o Protheus: duas linhas de título antes do cabeçalho, latin-1, ponto e vírgula e vírgula decimal
+def gravar_protheus(df, caminho, titulo):
+    with open(caminho, 'w', encoding='latin-1', newline='') as f:
+        f.write(f'{titulo}\r\nEmissao: {pd.Timestamp.today():%d/%m/%Y}\r\n')
+        df.to_csv(f, sep=';', decimal=',', float_format='%.2f', index=False, lineterminator='\r\n')
+
+def gerar_ct2(rng, quantidade, filiais, meses):
+    tipo = rng.choice(np.array(['1', '2', '3']), quantidade, p=[0.3, 0.3, 0.4])
+    contas = np.array(contas_resultado + contas_patrimoniais)
+    pesos = np.array([0.8 / len(contas_resultado)] * len(contas_resultado) + [0.2 / len(contas_patrimoniais)] * len(contas_patrimoniais))
+    debito = np.where(tipo != '2', rng.choice(contas, quantidade, p=pesos), '')
+    credito = np.where(tipo != '1', rng.choice(contas, quantidade, p=pesos), '')
+
+    numero = np.arange(quantidade)
+    return pd.DataFrame({
+        'Filial': '01',
+        'Data Lcto': datas_aleatorias(rng, meses, quantidade),
+        'Numero Lote': pd.Series(rng.integers(1, 9999, quantidade)).astype(str).str.zfill(6),
+        'Sub Lote': '001',
+        'Numero Doc': pd.Series(numero // 50).astype(str).str.zfill(6),
+        'Numero Linha': pd.Series(numero % 50 + 1).astype(str).str.zfill(3),
+        'Tipo Lcto': tipo,
+        'Cta Debito': debito,
+        'Cta Credito': credito,
+        'Valor': valores_aleatorios(rng, quantidade),
+        'Hist Lanc': rng.choice(historicos, quantidade),
+        'C Custo Deb': np.where(debito != '', rng.choice(centros_custo, quantidade), ''),
+        'C Custo Crd': np.where(credito != '', rng.choice(centros_custo, quantidade), ''),
+        'Rotina': rng.choice(rotinas, quantidade),
+        'Filial Orig': rng.choice(np.array(filiais), quantidade)
+    })
+
+def gerar_sa2(quantidade):
+    codigos = pd.Series(np.arange(1, quantidade + 1)).astype(str).str.zfill(6)
+    return pd.DataFrame({'Codigo': codigos, 'Razao Social': 'FORNECEDOR ' + codigos + ' LTDA'})
+
+def gerar_sc7(rng, quantidade, filiais, meses, fornecedores):
+    # Alguns pedidos com fornecedor inexistente na SA2
+    fornecedor = np.where(rng.random(quantidade) < 0.98, rng.choice(fornecedores, quantidade), '999999')
+    return pd.DataFrame({
+        'Filial': rng.choice(np.array(filiais), quantidade),
+        'Numero PC': pd.Series(np.arange(1, quantidade + 1)).astype(str).str.zfill(6),
+        'Fornecedor': fornecedor,
+        'Cta Contabil': rng.choice(np.array(contas_resultado[8:18]), quantidade),
+        'Vlr.Total': valores_aleatorios(rng, quantidade),
+        'Dt. Entrega': datas_aleatorias(rng, meses, quantidade),
+        'Centro Custo': rng.choice(centros_custo, quantidade),
+        'Tipo Entrada': rng.choice(np.array(['001', '01A', '102', '999', '051']), quantidade),
+        'Status': rng.choice(np.array(['Aprovado', 'B', 'L']), quantidade),
+        'Ped. Encerr.': rng.choice(np.array(['', '', 'E']), quantidade),
+        'Resid. Elim.': rng.choice(np.array(['', '', '', 'S']), quantidade)
+    })
+
+# Parâmetros de rateio com uma coluna por mês: valores absolutos (patrimonial) ou percentuais (corporativo)
+def gerar_parametros_rateio(rng, filiais_destino, meses, filial_origem, nome_origem, percentuais):
+    colunas_mes = [mes.start_time.to_pydatetime() for mes in meses]
+    valores = rng.integers(100, 5000, size=(len(filiais_destino), len(meses))).astype(float)
+    if percentuais:
+        valores = valores / valores.sum(axis=0)
+
+    rateio = pd.DataFrame(valores, columns=colunas_mes)
+    rateio.insert(0, 'Cod filial', [int(filial) for filial in filiais_destino])
+    rateio.insert(1, 'Filial', [accountfy.filiais[filial] for filial in filiais_destino])
+
+    origem = pd.DataFrame([[filial_origem, nome_origem] + [0.0] * len(meses)], columns=rateio.columns)
+    total = pd.DataFrame([['TOTAL', 'Total'] + list(valores.sum(axis=0))], columns=rateio.columns)
+    return pd.concat([rateio, origem, total], ignore_index=True)
+
+def gerar_plano_contas(caminho):
+    contas = sorted(set(contas_resultado + contas_patrimoniais + contas_automaticas))
+    plano = pd.DataFrame({'Código da conta': [int(conta) for conta in contas], 'Nome da conta': [f'Conta {conta}' for conta in contas]})
+    with pd.ExcelWriter(caminho) as writer:
+        pd.DataFrame([['Plano de contas'], ['Accountfy'], ['']]).to_excel(writer, sheet_name='CONTAS_CONTABEIS', index=False, header=False)
+        plano.to_excel(writer, sheet_name='CONTAS_CONTABEIS', index=False, startrow=3)
+
+def gerar_ajustes():
+    return pd.DataFrame({
+        'Conta': ['5101010101', '6101010101'],
+        'Valor': [1500.75, 1500.75],
+        'D/C': ['D', 'C'],
+        'Hist Lanc': ['Reclassificação de custo', 'Reclassificação de custo'],
+        'Centro de custo': ['10101', '10101'],
+        'Filial Orig': ['103', '105'],
+        'Obs': ['Ajuste sintético', 'Ajuste sintético']
+    })
+
+# Gera todos os arquivos de entrada na pasta informada. linhas = quantidade de linhas da CT2 da Tecadi
+def gerar_dados(pasta, linhas, meses=1, ultimo_mes=None, semente=0):
+    rng = np.random.default_rng(semente)
+    periodo = meses_periodo(ultimo_mes or pd.Timestamp.today().strftime('%Y-%m'), meses)
+    filiais_operacionais = [filial for filial in accountfy.aliquota_iss if filial != '101']
+    os.makedirs(pasta, exist_ok=True)
+
+    # Empresas com filial fixa (como a Dagnoni) recebem 1/20 das linhas
+    for empresa in accountfy.empresas.values():
+        if empresa['filial'] is None:
+            ct2 = gerar_ct2(rng, linhas, list(empresa['aliquota_iss']), periodo)
+        else:
+            ct2 = gerar_ct2(rng, max(linhas // 20, 1), ['01'], periodo)
+        gravar_protheus(ct2, os.path.join(pasta, empresa['ct2']), 'Lancamentos Contabeis')
+
+    sa2 = gerar_sa2(max(linhas // 200, 100))
+    gravar_protheus(sa2, os.path.join(pasta, accountfy.sa2_filename), 'Fornecedores')
+    gravar_protheus(gerar_sc7(rng, max(linhas // 100, 1), filiais_operacionais, periodo, sa2['Codigo'].to_numpy()), os.path.join(pasta, accountfy.sc7_filename), 'Pedidos de Compra')
+
+    gerar_parametros_rateio(rng, filiais_operacionais, periodo, 'ADM', 'Patrimonial', percentuais=False).to_excel(
+        os.path.join(pasta, accountfy.parametros_rateio_patrimonial_filename), index=False)
+    gerar_parametros_rateio(rng, filiais_operacionais, periodo, 101, 'Corporativo', percentuais=True).to_excel(
+        os.path.join(pasta, accountfy.parametros_rateio_corporativo_filename), index=False)
+    gerar_plano_contas(os.path.join(pasta, accountfy.plano_filename))
+    gerar_ajustes().to_excel(os.path.join(pasta, accountfy.ajustes_gerenciais_filename), index=False)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gera arquivos sintéticos no layout das exportações do Protheus')
+    parser.add_argument('--linhas', type=int, default=100000, help='quantidade de linhas da CT2 (a CT2 das demais empresas, a SC7 e a SA2 são proporcionais)')
+    parser.add_argument('--meses', type=int, default=1, help='quantidade de meses dos lançamentos, terminando no último mês')
+    parser.add_argument('--ultimo-mes', help='último mês dos lançamentos (AAAA-MM); padrão: mês atual')
+    parser.add_argument('--semente', type=int, default=0, help='semente dos números aleatórios, para gerar sempre os mesmos arquivos')
+    parser.add_argument('--pasta', default='Sinteticos', help='pasta onde os arquivos serão gravados')
+    args = parser.parse_args(argv)
+
+    gerar_dados(args.pasta, args.linhas, args.meses, args.ultimo_mes, args.semente)
+    print(f"Arquivos sintéticos gravados em {args.pasta}")
+
+if __name__ == '__main__':
+    main()